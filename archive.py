@@ -0,0 +1,91 @@
+import atexit
+import gzip
+import json
+import os
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from models import loads
+
+# Endpoints whose responses are archived
+archived_endpoints = ("orderlist", "orderdata")
+
+
+def params_key(params):
+    """Request params as recorded, the session excluded"""
+    return tuple(sorted(
+        (key, str(value)) for key, value in params.items() if value not in (None, "") and key != "sessionID"
+    ))
+
+
+class ResponseArchive(object):
+    """
+    Append-only archive of the raw orderlist and orderdata responses.
+
+    Each response is a JSON line {time, endpoint, params, response} of a gzip segment covering `segment_seconds`,
+    named after the epoch it starts at, so a time range only reads its own segments.
+    """
+
+    def __init__(self, directory, segment_seconds=3600):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+
+        self.segment = None
+        self.file = None
+
+    def path(self, segment):
+        return os.path.join(self.directory, f"{segment}.jsonl.gz")
+
+    def record(self, endpoint, url, response_json, at=None):
+        if endpoint not in archived_endpoints:
+            return
+
+        at = at or time.time()
+        segment = int(at // self.segment_seconds * self.segment_seconds)
+
+        if segment != self.segment:
+            self.close()
+            if self.segment is None:
+                os.makedirs(self.directory, exist_ok=True)
+                atexit.register(self.close)
+            self.segment = segment
+            self.file = gzip.open(self.path(segment), "at")
+
+        params = dict(parse_qsl(urlsplit(str(url)).query))
+        self.file.write(json.dumps({
+            "time": at,
+            "endpoint": endpoint,
+            "params": dict(params_key(params)),
+            "response": response_json,
+        }, default=str) + "\n")
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def segments(self, since=None, until=None):
+        """Start epochs of the segments overlapping [since, until), in order"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        segments = sorted(int(name.split(".")[0]) for name in names if name.endswith(".jsonl.gz"))
+        return [
+            segment for segment in segments
+            if (since is None or segment + self.segment_seconds > since) and (until is None or segment < until)
+        ]
+
+    def read(self, since=None, until=None):
+        """Records of [since, until), oldest first"""
+        for segment in self.segments(since, until):
+            try:
+                with gzip.open(self.path(segment), "rb") as f:
+                    for line in f:
+                        record = loads(line)
+                        if (since is None or record["time"] >= since) and (until is None or record["time"] < until):
+                            yield record
+            except (EOFError, gzip.BadGzipFile) as e:
+                # The segment being written by a running recorder can end with a partial member
+                print(f"Segment {segment} truncated: {e}")
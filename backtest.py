@@ -0,0 +1,162 @@
+import argparse
+import bisect
+import contextlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import secrets
+import main
+from archive import ResponseArchive, params_key
+from cache import OrderDataCache
+from history import PriceHistory
+from logger import logger
+from models import decode_response
+from rules import Rule
+from seen import SeenIndex
+from stepn import StepnNotFound, check_response_json
+
+
+class ArchiveIndex(object):
+    """Orderlist responses by request and time, and order details by order id, read from a ResponseArchive"""
+
+    def __init__(self, archive, since=None, until=None, requests=None):
+        # params key -> ([times], [responses]), oldest first
+        self.orderlist = {}
+        # order id -> response
+        self.orderdata = {}
+        self.start = self.end = None
+
+        for record in archive.read(since, until):
+            params, response = record["params"], record["response"]
+
+            # Archives written before only the successes were kept also hold the failed attempts
+            if response.get("code") != 0:
+                continue
+
+            if record["endpoint"] == "orderdata":
+                self.orderdata[params.get("orderId")] = response
+                continue
+
+            key = params_key(params)
+            # Only the requests of the rule, whatever their page
+            if requests is not None and params_key({k: v for k, v in params.items() if k != "page"}) not in requests:
+                continue
+
+            times, responses = self.orderlist.setdefault(key, ([], []))
+            times.append(record["time"])
+            responses.append(response)
+
+            self.start = min(self.start or record["time"], record["time"])
+            self.end = max(self.end or record["time"], record["time"])
+
+    def orderlist_at(self, key, at, max_age):
+        """Latest response of the request recorded at most `max_age` seconds before `at`"""
+        times, responses = self.orderlist.get(key, ((), ()))
+        index = bisect.bisect_right(times, at) - 1
+        if index < 0 or at - times[index] > max_age:
+            return None
+        return responses[index]
+
+
+class ReplayStepn(object):
+    """StepnRequest stand-in answering from the archive as it was at `at`"""
+
+    def __init__(self, index, at, max_age):
+        self.index = index
+        self.at = at
+        self.max_age = max_age
+
+    def get_orderlist(self, **kwargs):
+        response = self.index.orderlist_at(params_key(kwargs), self.at, self.max_age)
+        if response is None:
+            return {"code": 0, "data": []}
+        # The archived response is shared by the next replayed sweeps
+        return decode_response("orderlist", check_response_json(dict(response)))
+
+    def get_orderdata(self, order_id):
+        # The details of a listing don't change, whenever they were recorded
+        response = self.index.orderdata.get(str(order_id))
+        if response is None:
+            raise StepnNotFound()
+        return decode_response("orderdata", check_response_json(dict(response)))
+
+
+def requests_of(rule):
+    """Archive keys of the orderlist requests of the rule, whatever their page"""
+    return {params_key({k: v for k, v in params.items() if k != "page"}) for params in rule.requests}
+
+
+def backtest_rule(item, directory, since=None, until=None, step=60):
+    """Replays the archive through one rule every `step` seconds, returns its title and its (time, message) alerts"""
+    main.order_cache = OrderDataCache()
+    main.seen_index = SeenIndex()
+    main.price_history = PriceHistory(":memory:")
+    logger.filename = os.devnull
+
+    rule = Rule(item)
+    index = ArchiveIndex(ResponseArchive(directory), since=since, until=until, requests=requests_of(rule))
+
+    # The live sweeps fetched the unsplit pages when plan() shared them with other rules
+    if index.start is None and len(rule.requests) > 1:
+        rule.unsplit()
+        index = ArchiveIndex(ResponseArchive(directory), since=since, until=until, requests=requests_of(rule))
+
+    alerts = []
+    if index.start is None:
+        return rule.title, alerts
+
+    at = index.start
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while at <= index.end:
+            for message, _ in main.check_rule(ReplayStepn(index, at, max_age=step), rule):
+                alerts.append((at, message))
+            at += step
+
+    return rule.title, alerts
+
+
+def backtest(items, directory, since=None, until=None, step=60, workers=None):
+    """Backtests the rules in parallel, one process per rule"""
+    if workers == 1:
+        return [backtest_rule(item, directory, since, until, step) for item in items]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backtest_rule, item, directory, since, until, step) for item in items]
+        return [future.result() for future in futures]
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay the archived responses through the rules, without network")
+    parser.add_argument("--archive", default=main.ARCHIVE_DIRECTORY, help="directory of the ResponseArchive")
+    parser.add_argument("--rules", help="JSON file of rules to backtest instead of secrets.RULES")
+    parser.add_argument("--since", help="ISO start time, the start of the archive by default")
+    parser.add_argument("--until", help="ISO end time, the end of the archive by default")
+    parser.add_argument("--step", type=float, default=60, help="seconds between two replayed sweeps")
+    parser.add_argument("--workers", type=int, default=None, help="processes, 1 to backtest in this process")
+    args = parser.parse_args()
+
+    if not args.archive:
+        parser.error("--archive or secrets.ARCHIVE_DIRECTORY is required")
+
+    if args.rules:
+        with open(args.rules) as f:
+            items = json.load(f)
+    else:
+        items = secrets.RULES
+
+    started_at = time.perf_counter()
+    results = backtest(items, args.archive, parse_time(args.since), parse_time(args.until), args.step, args.workers)
+
+    for title, alerts in results:
+        print(f"{title}: {len(alerts)} alerts")
+        for at, message in alerts:
+            print(f"  {datetime.fromtimestamp(at).isoformat(timespec='seconds')} {message.splitlines()[0]}")
+
+    print(f"Backtested {len(items)} rules in {time.perf_counter() - started_at:.2f}s")
@@ -0,0 +1,127 @@
+import ast
+from functools import reduce
+
+import numpy as np
+
+from models import scaled_fields
+from rules import RuleError, operators, parse_conditions, unbind_vars
+
+batch_operators = {
+    ast.In: lambda a, b: np.isin(a, b),
+    ast.NotIn: lambda a, b: np.isin(a, b, invert=True),
+}
+
+
+class OrderColumns(object):
+    """
+    Columnar view of orderlist rows.
+
+    One float64 array per field, built on first use only, so the cost of a rule scales with the number of fields its
+    conditions read. Missing or null values are NaN, and never match a comparison.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, field):
+        if field not in self.columns:
+            column = np.array([row.get(field) for row in self.rows], dtype=np.float64)
+            if field in scaled_fields:
+                column /= scaled_fields[field]
+            self.columns[field] = column
+        return self.columns[field]
+
+
+def compile_batch_node(node, getters):
+    """Turns a whitelisted expression node into a function of the page columns returning one value per row"""
+    match node:
+        case ast.Expression(body=body):
+            return compile_batch_node(body, getters)
+        case ast.Constant(value=value):
+            return lambda columns: value
+        case ast.Name(id=name) if name in getters:
+            return getters[name]
+        case ast.Tuple(elts=elts) | ast.List(elts=elts) | ast.Set(elts=elts) if all(
+                isinstance(elt, ast.Constant) for elt in elts):
+            values = [elt.value for elt in elts]
+            return lambda columns: values
+        case ast.BoolOp(op=ast.And(), values=values):
+            functions = [compile_batch_node(value, getters) for value in values]
+            return lambda columns: reduce(np.logical_and, [function(columns) for function in functions])
+        case ast.BoolOp(op=ast.Or(), values=values):
+            functions = [compile_batch_node(value, getters) for value in values]
+            return lambda columns: reduce(np.logical_or, [function(columns) for function in functions])
+        case ast.UnaryOp(op=ast.Not(), operand=operand):
+            operand = compile_batch_node(operand, getters)
+            return lambda columns: np.logical_not(operand(columns))
+        case ast.UnaryOp(op=op, operand=operand) if type(op) in operators:
+            function, operand = operators[type(op)], compile_batch_node(operand, getters)
+            return lambda columns: function(operand(columns))
+        case ast.BinOp(op=op, left=left, right=right) if type(op) in operators:
+            function = operators[type(op)]
+            left, right = compile_batch_node(left, getters), compile_batch_node(right, getters)
+            return lambda columns: function(left(columns), right(columns))
+        case ast.Compare(left=left, ops=ops, comparators=comparators) if all(type(op) in operators for op in ops):
+            operands = [compile_batch_node(left, getters)] + [compile_batch_node(value, getters) for value in comparators]
+            functions = [batch_operators.get(type(op), operators[type(op)]) for op in ops]
+
+            def compare(columns):
+                values = [operand(columns) for operand in operands]
+                return reduce(np.logical_and, [function(a, b) for function, a, b in zip(functions, values, values[1:])])
+
+            return compare
+
+    raise RuleError(f"Unsupported expression {ast.unparse(node)!r}")
+
+
+def column_getter(var):
+    if "." in var:
+        raise RuleError(f"%{var} can't be evaluated on the orderlist columns")
+    return lambda columns: columns[var]
+
+
+def compile_batch_conditions(conditions):
+    """
+    Compile conditions once into a function of the page columns (see OrderColumns) returning the boolean mask of
+    the matching rows, the whole page is evaluated by numpy instead of one row at a time.
+    """
+    if not conditions:
+        raise RuleError("Empty conditions")
+
+    tree, variables = parse_conditions(conditions)
+
+    try:
+        getters = {name: column_getter(var) for var, name in variables.items()}
+        return compile_batch_node(tree, getters)
+    except RuleError as e:
+        raise RuleError(f"Invalid conditions {conditions!r}: {unbind_vars(e.message, variables)}")
+
+
+def mask_rows(rule, columns):
+    """Boolean mask of the rows meeting the rule conditions"""
+    return np.broadcast_to(np.asarray(rule.batch_conditions(columns), dtype=bool), (len(columns),))
+
+
+def filter_rows(rule, rows, columns=None):
+    """
+    Returns the rows meeting the rule conditions, in order.
+    The rows can be one page or several pages concatenated, the conditions are evaluated once for all of them.
+    """
+    if not rows:
+        return []
+    if rule.batch_conditions is None:
+        return rows
+
+    columns = columns if columns is not None else OrderColumns(rows)
+    try:
+        mask = mask_rows(rule, columns)
+    except (TypeError, ValueError) as e:
+        # Non numeric fields can't be turned into columns, the row conditions will check every row
+        print(f"Batch conditions unavailable for {rule}: {e}")
+        return rows
+
+    return [rows[index] for index in np.flatnonzero(mask)]
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import secrets
+import stepn
+import main
+from cache import OrderDataCache
+from history import PriceHistory
+from daemon import scan_rule
+from planner import AsyncSharedOrderlist
+from rules import compile_rules
+from seen import SeenIndex
+from stepn import StepnRequest, url_front
+from stepn_async import AsyncStepnRequest
+
+MOCK_STEPN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_stepn.py")
+
+ENGINES = ["sync", "sync-batch", "async", "async-batch"]
+
+
+def mock_get(port, path):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as response:
+        return json.loads(response.read())
+
+
+def start_mock(args):
+    """Starts mock_stepn.py in a subprocess and waits for it to answer"""
+    process = subprocess.Popen([
+        sys.executable, MOCK_STEPN,
+        "--port", str(args.port),
+        "--pages", str(args.pages),
+        "--latency", str(args.latency),
+        "--churn", str(args.churn),
+        "--not-authorized-rate", str(args.not_authorized_rate),
+        "--not-found-rate", str(args.not_found_rate),
+        "--error-rate", str(args.error_rate),
+        "--throttle-rate", str(args.throttle_rate),
+        "--seed", str(args.seed),
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            mock_get(args.port, "/mock/stats")
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise Exception(f"The mock Stepn API didn't start on port {args.port}")
+
+
+def reset_state(rules):
+    """Fresh caches and rules so that every engine starts from the same point"""
+    main.order_cache = OrderDataCache(maxsize=main.ORDERDATA_CACHE_SIZE, ttl=main.ORDERDATA_CACHE_TTL)
+    main.seen_index = SeenIndex(ttl=main.SEEN_TTL, maxsize=main.SEEN_MAXSIZE)
+    main.price_history = PriceHistory(":memory:")
+    main.rules_to_check = compile_rules(rules)
+    # The breakers opened and the throttling caused by the faults injected into the previous engine
+    StepnRequest.retry_policy.reset()
+    StepnRequest.throttle_delay = 0
+
+
+def sweep_sync(engine, args):
+    """Sweeps with main.scan, the alerts of a sweep are only queued at its end"""
+    queued = []
+    for _ in range(args.sweeps):
+        started_at = time.time()
+        alerts = main.scan(batch=engine.endswith("batch"))
+        queued.extend((alert, time.time()) for alert in alerts)
+        time.sleep(max(0, args.interval - (time.time() - started_at)))
+    return queued
+
+
+async def sweep_async(engine, args):
+    """Sweeps like daemon.watch, the alerts are queued as soon as they are found"""
+    queued = []
+
+    class TimestampQueue(object):
+        def put_nowait(self, alert):
+            queued.append((alert, time.time()))
+
+    async with AsyncStepnRequest(
+            email=main.STEPN_ACCOUNT,
+            password=main.STEPN_PASSWORD,
+            google_2auth_secret=main.GOOGLE_2AUTH,
+            rate=args.rate,
+            burst=args.burst,
+    ) as client:
+        for _ in range(args.sweeps):
+            started_at = time.time()
+            shared = AsyncSharedOrderlist(client)
+            await asyncio.gather(*(
+                scan_rule(shared, rule, TimestampQueue(), batch=engine.endswith("batch"))
+                for rule in main.rules_to_check
+            ))
+            main.save_caches()
+            await asyncio.sleep(max(0, args.interval - (time.time() - started_at)))
+
+    return queued
+
+
+def alert_latencies(port, queued):
+    """Seconds between the listing and the queuing of its alert, for the listings created during the run"""
+    pattern = re.compile(rf"{re.escape(url_front)}/order/(\d+)")
+    order_ids = {
+        int(found.group(1)): queued_at for (message, _), queued_at in queued if (found := pattern.search(message))
+    }
+    if not order_ids:
+        return []
+
+    created_at = mock_get(port, f"/mock/stats?ids={','.join(map(str, order_ids))}")["created_at"]
+    return [
+        queued_at - created_at[str(order_id)]
+        for order_id, queued_at in order_ids.items() if created_at.get(str(order_id))
+    ]
+
+
+def run_engine(engine, args, rules):
+    process = start_mock(args)
+    try:
+        reset_state(rules)
+
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        if engine.startswith("async"):
+            queued = asyncio.run(sweep_async(engine, args))
+        else:
+            queued = sweep_sync(engine, args)
+        wall_time = time.perf_counter() - started_at
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = mock_get(args.port, "/mock/stats")
+        latencies = sorted(alert_latencies(args.port, queued))
+    finally:
+        process.terminate()
+        process.wait()
+
+    requests = sum(stats["requests"].values())
+    return {
+        "engine": engine,
+        "wall_time": round(wall_time, 2),
+        "requests": requests,
+        "rows_per_sec": round(stats["rows_served"] / wall_time, 1),
+        "alerts": len(queued),
+        "requests_per_match": round(requests / len(queued), 1) if queued else None,
+        "latency_p50": round(statistics.median(latencies), 2) if latencies else None,
+        "latency_p99": round(latencies[math.ceil(0.99 * len(latencies)) - 1], 2) if latencies else None,
+        "peak_memory_kb": peak_memory // 1024,
+    }
+
+
+def print_results(results):
+    columns = list(results[0])
+    print(" | ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[column]):>18}" for column in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of the scan engines against mock_stepn.py, with the secrets.RULES rules"
+    )
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument("--rules", help="JSON file of rules to use instead of secrets.RULES")
+    parser.add_argument("--sweeps", type=int, default=3)
+    parser.add_argument("--interval", type=float, default=0, help="seconds between the start of two sweeps")
+    parser.add_argument("--delay", type=float, default=0, help="StepnRequest.rate_limit_delay of the sync engines")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second of the async engines")
+    parser.add_argument("--burst", type=int, default=10, help="burst size of the async engines")
+    parser.add_argument("--port", type=int, default=8777)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--churn", type=float, default=5)
+    parser.add_argument("--not-authorized-rate", type=float, default=0)
+    parser.add_argument("--not-found-rate", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.rules:
+        with open(args.rules) as f:
+            rules = json.load(f)
+    else:
+        rules = secrets.RULES
+
+    stepn.url_api = f"http://127.0.0.1:{args.port}/run"
+    StepnRequest.rate_limit_delay = args.delay
+
+    # The cookies and log.txt of the benchmark must not replace the real ones
+    os.chdir(tempfile.mkdtemp(prefix="stepn-bench-"))
+
+    print_results([run_engine(engine, args, rules) for engine in args.engines])
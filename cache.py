@@ -0,0 +1,83 @@
+import pickle
+import time
+from collections import OrderedDict
+
+
+class OrderDataCache(object):
+    """
+    LRU cache of get_orderdata responses by order id.
+
+    Entries expire after `ttl` seconds, the least recently used ones are dropped beyond `maxsize`, and an entry is
+    dropped as soon as the order is seen with another sell price. With a filename the cache is kept between runs.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600, filename=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.filename = filename
+
+        # order_id -> (expires_at, sell_price, details)
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.filename:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, order_id, price=None):
+        """Returns the cached details of the order, None when they are missing, expired or for another price"""
+        entry = self.entries.get(order_id)
+
+        if entry:
+            expires_at, sell_price, details = entry
+            if expires_at > time.time() and (price is None or price == sell_price):
+                self.entries.move_to_end(order_id)
+                self.hits += 1
+                return details
+
+            self.invalidate(order_id)
+
+        self.misses += 1
+        return None
+
+    def set(self, order_id, details, price=None):
+        self.entries[order_id] = (time.time() + self.ttl, price, details)
+        self.entries.move_to_end(order_id)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, order_id):
+        self.entries.pop(order_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 2) if total else 0,
+        }
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                entries = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return
+
+        now = time.time()
+        self.entries = OrderedDict(
+            (order_id, entry) for order_id, entry in entries.items() if entry[0] > now
+        )
+
+    def save(self):
+        if not self.filename:
+            return
+
+        with open(self.filename, 'wb') as f:
+            pickle.dump(self.entries, f)
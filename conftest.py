@@ -0,0 +1,16 @@
+import secrets
+
+# main reads the settings of the secrets.py of the user, the tests run with these ones when it is missing
+settings = {
+    "DISCORD_BOT_ID": "",
+    "DISCORD_BOT_TOKEN": "",
+    "DISCORD_BOT_PUBLIC": "",
+    "STEPN_ACCOUNT": "",
+    "STEPN_PASSWORD": "",
+    "GOOGLE_2AUTH": "",
+    "RULES": [],
+}
+
+for name, value in settings.items():
+    if not hasattr(secrets, name):
+        setattr(secrets, name, value)
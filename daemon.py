@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+
+from aiohttp import web
+
+import secrets
+from main import DISCORD_TOKEN, async_client, messages_dict, rules_to_check, check_rule_async, save_caches, \
+    load_baselines
+from metrics import registry
+from planner import plan, AsyncSharedOrderlist
+from scheduler import RuleScheduler
+from stepn_discord import StepnWatcherClient
+
+# Initial seconds between two checks of a rule, adapted by the scheduler within the min and max intervals
+SCAN_INTERVAL = getattr(secrets, "SCAN_INTERVAL", 60)
+SCAN_MIN_INTERVAL = getattr(secrets, "SCAN_MIN_INTERVAL", 10)
+SCAN_MAX_INTERVAL = getattr(secrets, "SCAN_MAX_INTERVAL", 600)
+# Optional maximum of orderlist requests per minute
+REQUEST_BUDGET = getattr(secrets, "REQUEST_BUDGET", None)
+# Optional port of the Prometheus /metrics endpoint
+METRICS_PORT = getattr(secrets, "METRICS_PORT", None)
+
+
+async def serve_metrics(port):
+    """Serves the metrics registry in the Prometheus text format on http://0.0.0.0:port/metrics"""
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.to_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
+
+
+async def scan_rule(stepn, rule, queue, batch=False):
+    """Check one rule and queue its alerts as soon as they are found, returns the number of alerts"""
+    try:
+        alerts = await check_rule_async(stepn, rule, batch=batch)
+    except Exception as e:
+        # One failing rule must not stop the watcher, it is checked again on the next sweep
+        print(f"Impossible to check {rule}: {e!r}")
+        return 0
+
+    for alert in alerts:
+        queue.put_nowait(alert)
+    return len(alerts)
+
+
+async def watch(interval=SCAN_INTERVAL, batch=False):
+    """
+    Keep one Stepn session and one Discord connection open, check each rule when the scheduler says so and stream the
+    alerts to the Discord send queue.
+    """
+    queue = asyncio.Queue()
+
+    client = StepnWatcherClient(queue, mention=messages_dict.get("mention"))
+    discord_task = asyncio.create_task(client.start(DISCORD_TOKEN))
+
+    metrics_runner = await serve_metrics(METRICS_PORT) if METRICS_PORT else None
+
+    try:
+        async with async_client() as stepn:
+            plan(rules_to_check)
+            load_baselines(rules_to_check)
+
+            scheduler = RuleScheduler(
+                rules_to_check,
+                interval=interval,
+                min_interval=SCAN_MIN_INTERVAL,
+                max_interval=SCAN_MAX_INTERVAL,
+                budget=REQUEST_BUDGET,
+            )
+
+            while not discord_task.done():
+                # Rules due soon are checked now, with the rules on the same orderlist
+                rules = scheduler.due(slack=SCAN_MIN_INTERVAL / 2)
+
+                if rules:
+                    # Orderlist pages are shared between the rules of one sweep only
+                    shared = AsyncSharedOrderlist(stepn)
+                    matches = await asyncio.gather(*(scan_rule(shared, rule, queue, batch=batch) for rule in rules))
+
+                    for rule, count in zip(rules, matches):
+                        scheduler.observe(rule, rule.new_listings, count)
+                        rule.new_listings = 0
+
+                    print(f"Orderlist: {shared.stats()}")
+                    print(f"Intervals: {scheduler.stats()}")
+                    save_caches()
+
+                await asyncio.sleep(scheduler.wait())
+
+            # The Discord client stopped by itself, raise its error
+            discord_task.result()
+    finally:
+        await client.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interval", type=float, default=SCAN_INTERVAL,
+                        help="initial seconds between two checks of a rule")
+    parser.add_argument("--batch", action="store_true",
+                        help="evaluate the rule conditions on whole pages at once with numpy")
+    args = parser.parse_args()
+
+    asyncio.run(watch(interval=args.interval, batch=args.batch))
@@ -0,0 +1,134 @@
+import sqlite3
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS prices (
+    rule_key TEXT NOT NULL,
+    chain TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    price REAL NOT NULL,
+    threshold REAL
+);
+CREATE INDEX IF NOT EXISTS prices_rule ON prices (rule_key, kind, time);
+CREATE INDEX IF NOT EXISTS prices_chain ON prices (chain, kind, time);
+
+CREATE TABLE IF NOT EXISTS baselines (
+    rule_key TEXT PRIMARY KEY,
+    chain TEXT NOT NULL,
+    time REAL NOT NULL,
+    price REAL NOT NULL,
+    threshold REAL,
+    configured_price REAL
+);
+"""
+
+# Columns added after the first release, missing from the tables created before
+migrations = [
+    "ALTER TABLE baselines ADD COLUMN configured_price REAL",
+]
+
+# Kinds of the price records
+FLOOR = "floor"
+MATCH = "match"
+
+
+class PriceHistory(object):
+    """
+    Append-only SQLite history of the prices observed by each rule.
+
+    Every sweep of a lowest price rule records the floor of its orderlist, and every alert of a price rule records a
+    match: its sell price becomes the new baseline of the rule. Baselines are read by primary key, and the history is
+    indexed by rule and by chain for the range queries of the rolling statistics.
+    """
+
+    def __init__(self, filename="prices.sqlite3"):
+        self.filename = filename
+        self._connection = None
+
+    @property
+    def connection(self):
+        """The database is only opened, and created, on its first use"""
+        if not self._connection:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(schema)
+            for migration in migrations:
+                try:
+                    self._connection.execute(migration)
+                except sqlite3.OperationalError:
+                    # Already applied
+                    pass
+
+        return self._connection
+
+    def record(self, rule_key, chain, price, kind=FLOOR, threshold=None, at=None, configured_price=None):
+        at = at or time.time()
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO prices (rule_key, chain, kind, time, price, threshold) VALUES (?, ?, ?, ?, ?, ?)",
+                (rule_key, chain, kind, at, price, threshold),
+            )
+            if kind == MATCH:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO baselines (rule_key, chain, time, price, threshold, configured_price) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (rule_key, chain, at, price, threshold, configured_price),
+                )
+
+    def baseline(self, rule_key, configured_price=None):
+        """
+        Sell price of the last match of the rule, None before its first match.
+        None as well when the configured price of the rule changed since that match, the new configured price wins.
+        """
+        row = self.connection.execute(
+            "SELECT price, configured_price FROM baselines WHERE rule_key = ?", (rule_key,)
+        ).fetchone()
+        if not row:
+            return None
+
+        price, matched_configured_price = row
+        # Baselines recorded before the configured price was stored are kept
+        if matched_configured_price is not None and matched_configured_price != configured_price:
+            return None
+        return price
+
+    def history(self, rule_key=None, chain=None, kind=FLOOR, since=None, until=None):
+        """(time, price) records of a rule or of a chain, oldest first"""
+        query = "SELECT time, price FROM prices WHERE kind = ?"
+        params = [kind]
+
+        for column, value in (("rule_key", rule_key), ("chain", chain)):
+            if value is not None:
+                query += f" AND {column} = ?"
+                params.append(value)
+        if since is not None:
+            query += " AND time >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND time < ?"
+            params.append(until)
+
+        return self.connection.execute(f"{query} ORDER BY time", params).fetchall()
+
+    def stats(self, rule_key=None, chain=None, kind=FLOOR, window=3600):
+        """Count, min, average and max price of the last `window` seconds"""
+        query = "SELECT COUNT(*), MIN(price), AVG(price), MAX(price) FROM prices WHERE kind = ? AND time >= ?"
+        params = [kind, time.time() - window]
+
+        for column, value in (("rule_key", rule_key), ("chain", chain)):
+            if value is not None:
+                query += f" AND {column} = ?"
+                params.append(value)
+
+        count, low, average, high = self.connection.execute(query, params).fetchone()
+        return {"count": count, "min": low, "average": average, "max": high}
+
+    def moving_average(self, rule_key, window=3600, kind=FLOOR):
+        """Average price of the rule over the last `window` seconds, None without any record"""
+        return self.stats(rule_key=rule_key, kind=kind, window=window)["average"]
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,103 @@
+import atexit
+import json
+import os
+import queue
+import threading
+from datetime import datetime
+
+
+class StructuredLogger(object):
+    """
+    Buffered JSON lines logger.
+
+    log() only queues the record; a background thread writes everything queued in one batch every `flush_interval`
+    seconds, or as soon as `batch_size` records are waiting. The file is rotated to filename.1 ... filename.`backups`
+    once it is bigger than `max_bytes`. What is still queued is written at exit.
+    """
+
+    def __init__(self, filename="log.txt", max_bytes=10 * 1024 * 1024, backups=3, flush_interval=1.0, batch_size=1000):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.records = queue.SimpleQueue()
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def log(self, message=None, **fields):
+        """Queue a record: its time, the message and any field (endpoint, rule, order_id, latency...)"""
+        record = {"time": datetime.now().isoformat(timespec="milliseconds")}
+        if message is not None:
+            record["message"] = message
+        record.update({key: value for key, value in fields.items() if value is not None})
+
+        self.records.put(record)
+
+        if not self.writer:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if not self.writer:
+                self.writer = threading.Thread(target=self.run, name="logger", daemon=True)
+                self.writer.start()
+                atexit.register(self.close)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.records.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            self.write([record for record in batch if record is not None])
+
+            if stop:
+                return
+
+    def write(self, batch):
+        if not batch:
+            return
+
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in batch)
+        try:
+            with open(self.filename, "a") as f:
+                f.write(lines)
+                size = f.tell()
+        except OSError as e:
+            print(f"Impossible to write {len(batch)} records to {self.filename}: {e}")
+            return
+
+        if size > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{index}"):
+                os.replace(f"{self.filename}.{index}", f"{self.filename}.{index + 1}")
+
+        if self.backups:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+
+    def close(self):
+        """Write what is still queued and stop the writer"""
+        with self.lock:
+            writer, self.writer = self.writer, None
+
+        if writer:
+            self.records.put(None)
+            writer.join()
+
+
+logger = StructuredLogger()
@@ -1,9 +1,24 @@
-import json
+import argparse
+import asyncio
+import heapq
+import itertools
 
 import secrets
-from stepn import StepnRequest, url_pics, mapping_chain_reversed, StepnNotFound, \
-    safe_evolution, safe_add_percent, safe_minus_percent, mapping_currency
-from stepn_discord import StepnClient
+from archive import ResponseArchive
+from cache import OrderDataCache
+from history import PriceHistory, FLOOR, MATCH
+from logger import logger
+from metrics import registry
+from models import scaled_value
+from planner import plan, SharedOrderlist, AsyncSharedOrderlist
+from retry import RetryPolicy
+from rules import compile_rules
+from seen import SeenIndex
+from stepn import StepnRequest, url_pics, StepnNotFound, StepnError, throttling_codes, \
+    safe_evolution, safe_add_percent, safe_minus_percent, mapping_currency, orderlist_page_size, \
+    mapping_order
+from stepn_async import AsyncStepnRequest
+from stepn_pool import AsyncStepnPool
 
 DISCORD_ID = secrets.DISCORD_BOT_ID
 DISCORD_TOKEN = secrets.DISCORD_BOT_TOKEN
@@ -14,118 +29,601 @@ STEPN_PASSWORD = secrets.STEPN_PASSWORD
 
 GOOGLE_2AUTH = secrets.GOOGLE_2AUTH
 
-rules_to_check = secrets.RULES
+# Optional other accounts of the async client, each one adds its own rate limit:
+# [{"email": ..., "password": ..., "google_2auth_secret": ...}, ...]
+STEPN_ACCOUNTS = getattr(secrets, "STEPN_ACCOUNTS", [])
+
+# Optional token bucket settings of the async client: requests per second and burst size
+STEPN_RATE = getattr(secrets, "STEPN_RATE", 1)
+STEPN_BURST = getattr(secrets, "STEPN_BURST", 1)
+# Optional seconds before a stalled Stepn request fails and is retried
+STEPN_TIMEOUT = getattr(secrets, "STEPN_TIMEOUT", 30)
+# Optional number of order details fetched at once by an async conditions_on_stats rule
+STEPN_WORKERS = getattr(secrets, "STEPN_WORKERS", 4)
+
+# Optional get_orderdata cache settings, it is only kept between runs with a filename
+ORDERDATA_CACHE_SIZE = getattr(secrets, "ORDERDATA_CACHE_SIZE", 10000)
+ORDERDATA_CACHE_TTL = getattr(secrets, "ORDERDATA_CACHE_TTL", 3600)
+ORDERDATA_CACHE_FILENAME = getattr(secrets, "ORDERDATA_CACHE_FILENAME", None)
+
+# Optional settings of the index of the listings already evaluated, it is only kept between runs with a filename
+SEEN_TTL = getattr(secrets, "SEEN_TTL", 86400)
+SEEN_MAXSIZE = getattr(secrets, "SEEN_MAXSIZE", 50000)
+SEEN_FILENAME = getattr(secrets, "SEEN_FILENAME", None)
+
+# Optional settings of the log file, rotated beyond LOG_MAX_BYTES
+logger.filename = getattr(secrets, "LOG_FILENAME", "log.txt")
+logger.max_bytes = getattr(secrets, "LOG_MAX_BYTES", 10 * 1024 * 1024)
+logger.backups = getattr(secrets, "LOG_BACKUPS", 3)
+
+# Optional JSON file the metrics are dumped to after every sweep
+METRICS_FILENAME = getattr(secrets, "METRICS_FILENAME", None)
+
+# Optional SQLite file of the prices observed by the rules, the last match of a price rule is its price limit
+PRICE_HISTORY_FILENAME = getattr(secrets, "PRICE_HISTORY_FILENAME", "prices.sqlite3")
+
+# Optional directory archiving every orderlist and orderdata response, to backtest the rules offline
+ARCHIVE_DIRECTORY = getattr(secrets, "ARCHIVE_DIRECTORY", None)
+if ARCHIVE_DIRECTORY:
+    StepnRequest.archive = ResponseArchive(ARCHIVE_DIRECTORY)
+
+# Optional retry settings of the Stepn requests: attempts per request, retries per minute and endpoint beyond
+# STEPN_RETRY_BUDGET of its requests, and failures in a row pausing an endpoint for STEPN_BREAKER_TIMEOUT seconds
+StepnRequest.retry_policy = RetryPolicy(
+    attempts=getattr(secrets, "STEPN_RETRY_ATTEMPTS", 3),
+    base_delay=getattr(secrets, "STEPN_RETRY_DELAY", 0.5),
+    budget_ratio=getattr(secrets, "STEPN_RETRY_BUDGET", 0.2),
+    breaker_threshold=getattr(secrets, "STEPN_BREAKER_THRESHOLD", 5),
+    breaker_timeout=getattr(secrets, "STEPN_BREAKER_TIMEOUT", 60),
+)
+# Optional stepn codes answered when throttled, besides HTTP 429
+throttling_codes.update(getattr(secrets, "STEPN_THROTTLING_CODES", []))
+
+# Invalid rules are reported here, before any request
+rules_to_check = compile_rules(secrets.RULES)
 
 messages_dict = {
     "mention": "stepnwatcher",
     "messages": [],
 }
 
+order_cache = OrderDataCache(maxsize=ORDERDATA_CACHE_SIZE, ttl=ORDERDATA_CACHE_TTL, filename=ORDERDATA_CACHE_FILENAME)
+seen_index = SeenIndex(ttl=SEEN_TTL, maxsize=SEEN_MAXSIZE, filename=SEEN_FILENAME)
+price_history = PriceHistory(PRICE_HISTORY_FILENAME)
 
-def main():
-    stop = False
-
-    stepn = StepnRequest(email=STEPN_ACCOUNT, password=STEPN_PASSWORD, google_2auth_secret=GOOGLE_2AUTH)
-    for item in rules_to_check:
-        title = item.get("title") if item.get("title") else ''
-        page = item.get("params").get("page")
-        limit = item.get("limit", 1000)
-        price = item.get("price")
-        threshold = item.get("threshold")
-        chain = mapping_chain_reversed[item.get('params').get('chain')]
-        image_enabled = item.get("image_enabled")
-
-        nb_matched = 0
-        while page <= item["page_end"]:
-            item["params"]["page"] = page
-
-            # stop condition
-            page += 1
-
-            rows = stepn.get_orderlist(**item["params"])
-            rows = rows.get("data") if rows else []
-
-            if limit and "conditions_on_stats" not in item:
-                rows = rows[:limit]
-
-            # For every shoe's in dict
-            for row in rows:
-                message = ''
-                image = ''
-
-                row = stepn.reduce_item(details=row)
-
-                conditions = item.get("conditions")
-                conditions = stepn.replace_binded_vars(conditions=conditions, row=row)
-
-                sell_price = row.get('sellPrice')
-
-                if eval(conditions):
-                    price_evolution = safe_evolution(row.get('sellPrice'), price, default=0)
-
-                    print(price_evolution, threshold)
-
-                    if (price_evolution and threshold and abs(price_evolution) > threshold) or not price:
-                        image = f"{url_pics}/{row.get('img')}" if image_enabled else None
-                        message = stepn.human_readable_stats(title=title, chain=chain, details=row)
-
-                        if price:
-                            message += f"\n{price_evolution}% from previous price, new price limit: "
-                            message += f"{sell_price} ${mapping_currency[chain]} (+{safe_add_percent(sell_price, threshold)} ${mapping_currency[chain]}/-{safe_minus_percent(sell_price, threshold)} {mapping_currency[chain]}) ({threshold}%)"
-                            with open(secrets.RATIO_FILENAME, 'w') as f:
-                                new_price = {
-                                    "price": row.get('sellPrice'),
-                                    "threshold": threshold,
-                                }
-                                json.dump(new_price, f, indent=4)
-
-                        with open("log.txt", "a") as log_file:
-                            log_file.write(message)
-
-                        stop = True
-
-                if conditions_on_stats := item.get("conditions_on_stats"):
-                    try:
-                        details = stepn.get_orderdata(order_id=row.get('id'))
-
-                        conditions_on_stats = stepn.replace_detail_binded_vars(
-                            conditions=conditions_on_stats,
-                            row=details
-                        )
-
-                        message += f" - " + \
-                                   f"{stepn.get_orderdata_attrs(details, 'Efficiency') / 10} eff - " + \
-                                   f"{stepn.get_orderdata_attrs(details, 'Luck') / 10} luck - " + \
-                                   f"{stepn.get_orderdata_attrs(details, 'Comfort') / 10} com - " + \
-                                   f"{stepn.get_orderdata_attrs(details, 'Resilience') / 10} res\n"
-
-                        with open("log.txt", "a") as log_file:
-                            log_file.write(message)
-
-                        if conditions_on_stats and eval(conditions_on_stats):
-                            log_file.write('MATCHED!')
-                            nb_matched += 1
-                        else:
-                            message = None
-                            image = None
-                    except StepnNotFound:
-                        print(f"Met conditions but order {row.get('id')} is already gone.")
-                        message = None
-                        image = None
-
-                if message and (image or not image_enabled):
-                    print(message)
-                    messages_dict["messages"].append((message, image))
-
-                # This is for the details limit
-                if nb_matched >= limit or stop:
-                    page = item["page_end"] + 1
-                    break
-    
+
+def load_baselines(rules):
+    """
+    The price limit of a price rule is the sell price of its last match, its configured price before that or once the
+    configured price is changed
+    """
+    for rule in rules:
+        if rule.price and (baseline := price_history.baseline(rule.key, rule.item.get("price"))) is not None:
+            rule.price = baseline
+
+
+def baseline_price(rule):
+    """Price the rule compares the sell prices to: its price limit, or the moving average of its floor prices"""
+    if rule.price and rule.baseline_window:
+        return price_history.moving_average(rule.key, window=rule.baseline_window) or rule.price
+
+    return rule.price
+
+
+def record_floor(rule, rows):
+    """Records the lowest price of a lowest price rule from the first page of its sweep"""
+    if rule.params.get("order") != mapping_order["lowest_price"]:
+        return
+
+    prices = [row['sellPrice'] for row in rows if row.get('sellPrice') is not None]
+    if prices:
+        price_history.record(rule.key, rule.chain, StepnRequest.reduce_price(min(prices)), kind=FLOOR)
+
+
+def match_row(rule, row):
+    """Returns the (message, image) alert of the row if it meets the rule conditions, None otherwise"""
+    price = baseline_price(rule)
+    threshold = rule.threshold
+    chain = rule.chain
+
+    # The orderlist rows are shared between the rules, they keep the integer price
+    sell_price = scaled_value(row, 'sellPrice')
+
+    if not rule.conditions(row):
+        return None
+
+    price_evolution = safe_evolution(sell_price, price, default=0)
+
+    print(price_evolution, threshold)
+
+    if not ((price_evolution and threshold and abs(price_evolution) > threshold) or not price):
+        return None
+
+    image = f"{url_pics}/{row.get('img')}" if rule.image_enabled else None
+    message = StepnRequest.human_readable_stats(title=rule.title, chain=chain, details=row)
+
+    if price:
+        message += f"\n{price_evolution}% from previous price, new price limit: "
+        message += f"{sell_price} ${mapping_currency[chain]} (+{safe_add_percent(sell_price, threshold)} ${mapping_currency[chain]}/-{safe_minus_percent(sell_price, threshold)} {mapping_currency[chain]}) ({threshold}%)"
+        price_history.record(rule.key, chain, sell_price, kind=MATCH, threshold=threshold,
+                             configured_price=rule.item.get("price"))
+
+        # Long-running scans compare the next prices to the new limit
+        rule.price = sell_price
+
+    logger.log(message, rule=rule.title, order_id=row.get('id'))
+
+    return message, image
+
+
+def match_details(rule, details, message, order_id=None):
+    """Returns the message completed with the shoe stats if the details meet the rule conditions_on_stats"""
+    message += f" - " + \
+               f"{StepnRequest.get_orderdata_attrs(details, 'Efficiency') / 10} eff - " + \
+               f"{StepnRequest.get_orderdata_attrs(details, 'Luck') / 10} luck - " + \
+               f"{StepnRequest.get_orderdata_attrs(details, 'Comfort') / 10} com - " + \
+               f"{StepnRequest.get_orderdata_attrs(details, 'Resilience') / 10} res\n"
+
+    matched = rule.conditions_on_stats(details)
+    logger.log(message, rule=rule.title, order_id=order_id, matched=matched)
+
+    return message if matched else None
+
+
+def is_sendable(rule, alert):
+    message, image = alert
+    return message and (image or not rule.image_enabled)
+
+
+def is_seen(rule, row):
+    """Unchanged listings were already evaluated by a previous sweep, against the same price limit"""
+    # The limit of a moving average rule changes on every sweep, its listings are always evaluated again
+    if rule.price and rule.baseline_window:
+        return False
+    return seen_index.seen(rule.key, row, price=rule.price)
+
+
+def mark_seen(rule, row):
+    if not (rule.price and rule.baseline_window):
+        seen_index.add(rule.key, row, price=rule.price)
+
+
+def is_rule_done(rule, alerts):
+    # Only a conditions_on_stats rule alerts up to its limit, the others stop at their first alert. A price rule only
+    # alerts once per run since its new price limit has been saved
+    if rule.conditions_on_stats and not rule.price:
+        return len(alerts) >= rule.limit
+    return bool(alerts)
+
+
+def limit_pages(rule, pages):
+    for rows in pages:
+        if rule.limit and not rule.conditions_on_stats:
+            rows = rows[:rule.limit]
+
+        yield rows
+
+
+def iter_rows(rule, pages, batch=False):
+    """Rows to check, in batch mode the rows not meeting the conditions are already filtered out page by page"""
+    if batch:
+        # numpy is only imported by the runs in batch mode
+        from batch import filter_rows
+
+    for rows in limit_pages(rule, pages):
+        registry.inc("rule_pages_total", rule=rule.title)
+        registry.inc("rule_rows_total", len(rows), rule=rule.title)
+
+        yield from filter_rows(rule, rows) if batch else rows
+
+
+def iter_request_pages(stepn, rule, params, watermark=None):
+    """Pages of one request of the rule, up to its last page or until the next pages can't match anymore"""
+    for page in range(params["page"], rule.request_page_end + 1):
+        rows = stepn.get_orderlist(**{**params, "page": page})
+        rows = rows.get("data") if rows else []
+
+        if page == params["page"]:
+            rule.observe_watermark(rows)
+
+        # Checked before the rows are reduced by match_row
+        exhausted = rule.is_exhausted(rows, watermark)
+
+        yield rows
+
+        if exhausted:
+            return
+
+
+def merge_pages(rule, requests_pages):
+    """Rows of several requests merged back in the server order, by pages"""
+    rows = heapq.merge(*(itertools.chain.from_iterable(pages) for pages in requests_pages), key=rule.order_key)
+
+    while page := list(itertools.islice(rows, orderlist_page_size)):
+        yield page
+
+
+def iter_orderlist_pages(stepn, rule):
+    watermark = rule.watermark
+    requests_pages = [iter_request_pages(stepn, rule, params, watermark) for params in rule.requests]
+
+    pages = requests_pages[0] if len(requests_pages) == 1 else merge_pages(rule, requests_pages)
+
+    for page, rows in enumerate(pages):
+        if page == 0:
+            record_floor(rule, rows)
+        yield rows
+
+
+def get_orderdata(stepn, row):
+    """StepnRequest.get_orderdata through the order_cache"""
+    order_id, price = row.get('id'), row.get('sellPrice')
+
+    if (details := order_cache.get(order_id, price=price)) is not None:
+        return details
+
+    try:
+        details = stepn.get_orderdata(order_id=order_id)
+    except StepnNotFound:
+        order_cache.invalidate(order_id)
+        raise
+
+    order_cache.set(order_id, details, price=price)
+    return details
+
+
+async def get_orderdata_async(stepn, row):
+    """AsyncStepnRequest.get_orderdata through the order_cache"""
+    order_id, price = row.get('id'), row.get('sellPrice')
+
+    if (details := order_cache.get(order_id, price=price)) is not None:
+        return details
+
+    try:
+        details = await stepn.get_orderdata(order_id=order_id)
+    except StepnNotFound:
+        order_cache.invalidate(order_id)
+        raise
+
+    order_cache.set(order_id, details, price=price)
+    return details
+
+
+def save_caches():
+    print(f"Order data cache: {order_cache.stats()}")
+    order_cache.save()
+
+    print(f"Seen listings: {seen_index.stats()}")
+    seen_index.save()
+
+    print(f"Circuit breakers: {StepnRequest.retry_policy.stats()}")
+
+    if METRICS_FILENAME:
+        registry.dump(METRICS_FILENAME)
+
+
+def check_rule(stepn, rule, batch=False):
+    """Returns the (message, image) alerts of one rule"""
+    alerts = []
+    # Every listing of the pages was evaluated, see Rule.advance_watermark
+    complete = True
+
+    try:
+        # For every shoe's in dict, pages are only fetched when the previous one is exhausted
+        for row in iter_rows(rule, iter_orderlist_pages(stepn, rule), batch=batch):
+            # Unchanged listings were already evaluated by a previous sweep
+            if is_seen(rule, row):
+                continue
+            rule.new_listings += 1
+
+            alert = match_row(rule, row)
+
+            if alert and rule.conditions_on_stats:
+                message, image = alert
+                try:
+                    details = get_orderdata(stepn, row)
+                    message = match_details(rule, details, message, order_id=row.get('id'))
+                    alert = (message, image) if message else None
+                except StepnNotFound:
+                    print(f"Met conditions but order {row.get('id')} is already gone.")
+                    alert = None
+                except StepnError as e:
+                    # Not marked as seen, the next sweep checks it again
+                    print(f"Impossible to check the details of order {row.get('id')}: {e.message}")
+                    complete = False
+                    continue
+
+            mark_seen(rule, row)
+
+            if alert and is_sendable(rule, alert):
+                print(alert[0])
+                registry.inc("rule_matches_total", rule=rule.title)
+                alerts.append(alert)
+
+            # This is for the details limit
+            if is_rule_done(rule, alerts):
+                complete = False
+                break
+    except StepnError as e:
+        # The pages left are checked by the next sweep, the alerts already found are kept
+        print(f"{rule} stopped early: {e.message}")
+        registry.inc("rule_errors_total", rule=rule.title)
+        complete = False
+
+    rule.advance_watermark(complete)
+    return alerts
+
+
+async def iter_rule_pages(stepn, rule):
+    """Async generator of the pages of the rule, a single request streams its pages as soon as they are fetched"""
+    watermark = rule.watermark
+
+    def until(rows):
+        return rule.is_exhausted(rows, watermark)
+
+    if len(rule.requests) == 1:
+        first = True
+        async for rows in stepn.iter_orderlist_pages(page_end=rule.request_page_end, until=until, **rule.requests[0]):
+            if first:
+                rule.observe_watermark(rows)
+                first = False
+            yield rows
+        return
+
+    # Split requests are merged back in the server order, which needs all their pages
+    requests_pages = await asyncio.gather(*(
+        stepn.get_orderlist_pages(page_end=rule.request_page_end, until=until, **params) for params in rule.requests
+    ))
+
+    for pages in requests_pages:
+        rule.observe_watermark(pages[0] if pages else [])
+
+    for rows in merge_pages(rule, requests_pages):
+        yield rows
+
+
+async def check_candidates(stepn, rule, candidates, alerts, done, errors, skipped):
+    """
+    Worker of the second stage: checks the details of the candidates until the rule is done, the candidates it
+    couldn't check are added to `skipped`
+    """
+    while True:
+        row, (message, image) = await candidates.get()
+        try:
+            # Candidates queued before the rule was done are dropped
+            if done.is_set():
+                continue
+
+            try:
+                details = await get_orderdata_async(stepn, row)
+            except StepnNotFound:
+                print(f"Met conditions but order {row.get('id')} is already gone.")
+                mark_seen(rule, row)
+                continue
+            except StepnError as e:
+                # Not marked as seen, the next sweep checks it again
+                print(f"Impossible to check the details of order {row.get('id')}: {e.message}")
+                skipped.append(row)
+                continue
+
+            # Another worker reached the limit while the details were fetched, the next sweep checks it again
+            if done.is_set() or is_rule_done(rule, alerts):
+                continue
+
+            mark_seen(rule, row)
+
+            message = match_details(rule, details, message, order_id=row.get('id'))
+
+            if message and is_sendable(rule, (message, image)):
+                print(message)
+                registry.inc("rule_matches_total", rule=rule.title)
+                alerts.append((message, image))
+
+            if is_rule_done(rule, alerts):
+                done.set()
+        except Exception as e:
+            # Stops the rule, the error is raised by check_rule_async
+            errors.append(e)
+            done.set()
+        finally:
+            candidates.task_done()
+
+
+async def check_rule_async(stepn, rule, batch=False):
+    """
+    Same as check_rule, as a two-stage pipeline.
+
+    The first stage filters the orderlist pages as they are fetched and streams the candidates of the
+    conditions_on_stats rules to a bounded pool of STEPN_WORKERS workers fetching their details concurrently.
+    Once the rule has its limit of alerts, the pending pages and details requests are cancelled.
+    """
+    alerts = []
+    errors = []
+    skipped = []
+    complete = False
+    done = asyncio.Event()
+    candidates = asyncio.Queue(maxsize=STEPN_WORKERS)
+
+    async def filter_pages():
+        nonlocal complete
+        first = True
+        async for pages in iter_rule_pages(stepn, rule):
+            if first:
+                record_floor(rule, pages)
+                first = False
+
+            for row in iter_rows(rule, [pages], batch=batch):
+                # Unchanged listings were already evaluated by a previous sweep
+                if is_seen(rule, row):
+                    continue
+                rule.new_listings += 1
+
+                alert = match_row(rule, row)
+
+                # Candidates are only evaluated once their details are checked
+                if not (alert and rule.conditions_on_stats):
+                    mark_seen(rule, row)
+
+                if not alert:
+                    continue
+
+                if rule.conditions_on_stats:
+                    # Waits for a free worker
+                    await candidates.put((row, alert))
+
+                    # A price rule stops at its first candidate
+                    if rule.price:
+                        return
+                elif is_sendable(rule, alert):
+                    print(alert[0])
+                    registry.inc("rule_matches_total", rule=rule.title)
+                    alerts.append(alert)
+
+                if done.is_set() or is_rule_done(rule, alerts):
+                    return
+
+        complete = True
+
+    async def run_pipeline():
+        await filter_pages()
+        await candidates.join()
+
+    workers = []
+    if rule.conditions_on_stats:
+        workers = [
+            asyncio.create_task(check_candidates(stepn, rule, candidates, alerts, done, errors, skipped))
+            for _ in range(STEPN_WORKERS)
+        ]
+
+    pipeline = asyncio.create_task(run_pipeline())
+    limit_reached = asyncio.create_task(done.wait())
+    try:
+        await asyncio.wait([pipeline, limit_reached], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in [pipeline, limit_reached, *workers]:
+            task.cancel()
+        await asyncio.gather(pipeline, limit_reached, *workers, return_exceptions=True)
+
+    if pipeline.done() and not pipeline.cancelled() and pipeline.exception():
+        errors.append(pipeline.exception())
+
+    for error in errors:
+        if not isinstance(error, StepnError):
+            raise error
+    if errors:
+        # The pages left are checked by the next sweep, the alerts already found are kept
+        print(f"{rule} stopped early: {errors[0].message}")
+        registry.inc("rule_errors_total", rule=rule.title)
+
+    # Every listing of the pages was evaluated, see Rule.advance_watermark
+    rule.advance_watermark(complete and not done.is_set() and not errors and not skipped)
+    return alerts
+
+
+def send_alerts():
     if messages_dict["messages"]:
+        # discord is only imported by the runs with alerts to send
+        from stepn_discord import StepnClient
+
         client = StepnClient(messages_dict=messages_dict)
         client.run(DISCORD_TOKEN)
 
 
+def scan(batch=False):
+    """One sweep of every rule, returns their (message, image) alerts"""
+    stepn = StepnRequest(email=STEPN_ACCOUNT, password=STEPN_PASSWORD, google_2auth_secret=GOOGLE_2AUTH,
+                         timeout=STEPN_TIMEOUT)
+    stepn = SharedOrderlist(stepn)
+    load_baselines(rules_to_check)
+
+    alerts = []
+
+    # Rules on the same orderlist are checked together, their pages are released afterwards
+    for rules in plan(rules_to_check).values():
+        for rule in rules:
+            try:
+                alerts.extend(check_rule(stepn, rule, batch=batch))
+            except Exception as e:
+                # One failing rule must not stop the sweep, it is checked again on the next one
+                print(f"Impossible to check {rule}: {e!r}")
+        stepn.release()
+
+    print(f"Orderlist: {stepn.stats()}")
+    save_caches()
+    # The next run starts from the last validation
+    stepn.save_cookies()
+
+    return alerts
+
+
+def main(batch=False):
+    messages_dict["messages"].extend(scan(batch=batch))
+
+    send_alerts()
+
+
+def async_client():
+    """AsyncStepnRequest of STEPN_ACCOUNT, or a pool of it and the STEPN_ACCOUNTS"""
+    if not STEPN_ACCOUNTS:
+        return AsyncStepnRequest(
+            email=STEPN_ACCOUNT,
+            password=STEPN_PASSWORD,
+            google_2auth_secret=GOOGLE_2AUTH,
+            rate=STEPN_RATE,
+            burst=STEPN_BURST,
+            timeout=STEPN_TIMEOUT,
+        )
+
+    account = {"email": STEPN_ACCOUNT, "password": STEPN_PASSWORD, "google_2auth_secret": GOOGLE_2AUTH,
+               "cookies_filename": "cookies"}
+    return AsyncStepnPool([account, *STEPN_ACCOUNTS], rate=STEPN_RATE, burst=STEPN_BURST, timeout=STEPN_TIMEOUT)
+
+
+async def scan_async(batch=False):
+    async with async_client() as stepn:
+        results = await scan_rules_async(stepn, batch=batch)
+
+    save_caches()
+    return results
+
+
+async def scan_rules_async(stepn, batch=False):
+    """One sweep of every rule, the orderlist pages common to several rules are only fetched once"""
+    plan(rules_to_check)
+    load_baselines(rules_to_check)
+    stepn = AsyncSharedOrderlist(stepn)
+
+    # Every rule is checked at once, the token bucket keeps the sweep under the API rate limit
+    results = await asyncio.gather(
+        *(check_rule_async(stepn, rule, batch=batch) for rule in rules_to_check), return_exceptions=True
+    )
+
+    for index, (rule, result) in enumerate(zip(rules_to_check, results)):
+        if isinstance(result, Exception):
+            # One failing rule must not stop the sweep, it is checked again on the next one
+            print(f"Impossible to check {rule}: {result!r}")
+            results[index] = []
+
+    print(f"Orderlist: {stepn.stats()}")
+    return results
+
+
+def main_async(batch=False):
+    for alerts in asyncio.run(scan_async(batch=batch)):
+        messages_dict["messages"].extend(alerts)
+
+    send_alerts()
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="fetch pages and order details concurrently within the STEPN_RATE/STEPN_BURST limits")
+    parser.add_argument("--batch", action="store_true",
+                        help="evaluate the rule conditions on whole pages at once with numpy")
+    args = parser.parse_args()
+
+    if args.use_async:
+        main_async(batch=args.batch)
+    else:
+        main(batch=args.batch)
@@ -0,0 +1,130 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram(object):
+    """Cumulative histogram in the Prometheus way: each bucket counts the values lower or equal to its bound"""
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "buckets": {str(bound): count for bound, count in self.cumulative_counts()},
+        }
+
+
+def labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key):
+    if not key:
+        return ""
+
+    labels = ",".join(f'{name}="{escape_label(value)}"' for name, value in key)
+    return f"{{{labels}}}"
+
+
+class MetricsRegistry(object):
+    """
+    In-process counters and histograms, by name and labels.
+
+    The registry is exported with to_prometheus (text exposition format) or dump (JSON file). Updates are locked since
+    the async client logs in from a worker thread.
+    """
+
+    def __init__(self):
+        # name -> {labels key -> value}
+        self.counters = {}
+        # name -> {labels key -> Histogram}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            key = labels_key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, buckets=latency_buckets, **labels):
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            key = labels_key(labels)
+            if key not in histograms:
+                histograms[key] = Histogram(buckets)
+            histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the seconds spent in the with block"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in values.items()]
+                    for name, values in self.counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key), **histogram.to_dict()} for key, histogram in histograms.items()]
+                    for name, histograms in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, values in self.counters.items():
+                lines.append(f"# TYPE {name} counter")
+                for key, value in values.items():
+                    lines.append(f"{name}{format_labels(key)} {value}")
+
+            for name, histograms in self.histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in histograms.items():
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f"{name}_bucket{format_labels((*key, ('le', str(bound))))} {count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_json(), f, indent=4)
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from stepn import mapping_order, orderlist_page_size
+
+
+class MockStepn(object):
+    """
+    Local stand-in of the Stepn API endpoints used by StepnRequest, with the response shapes documented in
+    StepnRequest.get_orderlist and StepnRequest.get_orderdata.
+
+    The market holds `pages` full orderlist pages of listings. With `churn`, that many listings per second are sold
+    and replaced by new ones. Every request waits `latency` seconds, and the orderlist and orderdata requests fail
+    with the NotAuthorized (102001) or NotFound (212017) codes, HTTP 503 (`error_rate`) or HTTP 429 (`throttle_rate`)
+    at the given rates.
+    """
+
+    def __init__(self, pages=10, latency=0.0, churn=0.0, not_authorized_rate=0.0, not_found_rate=0.0, error_rate=0.0,
+                 throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.churn = churn
+        self.not_authorized_rate = not_authorized_rate
+        self.not_found_rate = not_found_rate
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+
+        self.next_id = 206300000
+        self.listings = {}
+        self.details = {}
+        # order id -> epoch the listing was put on sale
+        self.created_at = {}
+        self.sessions = set()
+
+        self.requests = Counter()
+        self.rows_served = 0
+
+        for _ in range(pages * orderlist_page_size):
+            self.add_listing(created_at=0)
+        self.updated_at = time.time()
+
+    def add_listing(self, created_at):
+        order_id, self.next_id = self.next_id, self.next_id + 1
+        level, quality, mint = self.random.randint(0, 30), self.random.randint(1, 5), self.random.randint(0, 7)
+
+        self.listings[order_id] = {
+            "id": order_id,
+            "otd": self.random.randint(100000000, 999999999),
+            "time": int(created_at * 1000),
+            "propID": self.random.randint(10 ** 10, 2 * 10 ** 11),
+            "img": f"{order_id % 50}/{order_id % 49}/m218706_{order_id:x}_67.png",
+            "dataID": self.random.choice([100054, 100064, 100093, 100102, 100107, 100112, 100117]),
+            "sellPrice": self.random.randint(100, 400) * 10000,
+            "hp": 100,
+            "level": level,
+            "quality": quality,
+            "mint": mint,
+            "addRatio": 40,
+            "lifeRatio": 10000,
+            "v1": self.random.randint(10, 400),
+            "v2": self.random.randint(10, 100),
+            "speedMax": 556,
+            "speedMin": 223,
+        }
+        self.details[order_id] = {
+            "id": self.listings[order_id]["propID"],
+            "state": 1230,
+            "type": 3,
+            "dataID": self.listings[order_id]["dataID"],
+            "chain": 103,
+            "level": level,
+            "quality": quality,
+            "hp": 100,
+            "attrs": [self.random.randint(10, 40 * quality) for _ in range(4)] + [0] * 8,
+            "speedMin": 223,
+            "speedMax": 556,
+            "breed": mint,
+            "otd": self.listings[order_id]["otd"],
+            "shoeImg": self.listings[order_id]["img"],
+            "lifeRatio": 10000,
+        }
+        self.created_at[order_id] = created_at
+
+    def update_market(self):
+        """Sell and list `churn` listings per second since the last request"""
+        now = time.time()
+        changes = int((now - self.updated_at) * self.churn)
+        if not changes:
+            return
+
+        self.updated_at = now
+        for order_id in self.random.sample(list(self.listings), min(changes, len(self.listings))):
+            del self.listings[order_id]
+            del self.details[order_id]
+        for _ in range(changes):
+            self.add_listing(created_at=now)
+
+    def orderlist(self, query):
+        self.update_market()
+
+        rows = self.listings.values()
+        for param, field in (("quality", "quality"), ("level", "level"), ("bread", "mint")):
+            if query.get(param) not in (None, ""):
+                rows = [row for row in rows if row[field] == int(query[param])]
+
+        match int(query.get("order", mapping_order["lowest_price"])):
+            case order if order == mapping_order["highest_price"]:
+                rows = sorted(rows, key=lambda row: (-row["sellPrice"], row["id"]))
+            case order if order == mapping_order["latest"]:
+                rows = sorted(rows, key=lambda row: (-row["time"], -row["id"]))
+            case _:
+                rows = sorted(rows, key=lambda row: (row["sellPrice"], row["id"]))
+
+        page = int(query.get("page", 0))
+        rows = rows[page * orderlist_page_size:(page + 1) * orderlist_page_size]
+        self.rows_served += len(rows)
+
+        return {"code": 0, "data": rows}
+
+    def orderdata(self, query):
+        self.update_market()
+
+        order_id = int(query.get("orderId", 0))
+        if order_id not in self.details or self.random.random() < self.not_found_rate:
+            return {"code": 212017, "msg": "Order does not exist"}
+
+        return {"code": 0, "data": self.details[order_id]}
+
+    async def handle(self, request):
+        endpoint = request.match_info["endpoint"]
+        query = request.query
+        self.requests[endpoint] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        match endpoint:
+            case "login":
+                session_id = f"mock{self.random.randint(0, 10 ** 12)}"
+                self.sessions.add(session_id)
+                return web.json_response({"code": 0, "data": {"sessionID": session_id}})
+            case "doCodeCheck":
+                return web.json_response({"code": 0, "data": {}})
+
+        if query.get("sessionID") not in self.sessions:
+            return web.json_response({"code": 102001, "msg": "Player hasnt logged in yet"})
+
+        match endpoint:
+            case "userbasic":
+                return web.json_response({"code": 0, "data": {"email": "mock@stepn.local"}})
+            case "orderlist" | "orderdata":
+                if self.random.random() < self.error_rate:
+                    return web.Response(status=503, text="Service Unavailable")
+                if self.random.random() < self.throttle_rate:
+                    return web.Response(status=429, text="Too Many Requests")
+                if self.random.random() < self.not_authorized_rate:
+                    # The session expired, a new login is needed
+                    self.sessions.discard(query.get("sessionID"))
+                    return web.json_response({"code": 102001, "msg": "Player hasnt logged in yet"})
+                return web.json_response(getattr(self, endpoint)(query))
+
+        return web.json_response({"code": 404, "msg": f"Unknown endpoint {endpoint}"})
+
+    async def handle_stats(self, request):
+        """Counters of the mock, and the creation epoch of the listings given by `ids`"""
+        ids = [int(order_id) for order_id in request.query.get("ids", "").split(",") if order_id]
+        return web.json_response({
+            "requests": dict(self.requests),
+            "rows_served": self.rows_served,
+            "created_at": {order_id: self.created_at.get(order_id) for order_id in ids},
+        })
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/run/{endpoint}", self.handle)
+        app.router.add_get("/mock/stats", self.handle_stats)
+        return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the Stepn API, use http://host:port/run as url_api")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8777)
+    parser.add_argument("--pages", type=int, default=10, help="orderlist pages of listings on the market")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--churn", type=float, default=0.0, help="listings sold and listed per second")
+    parser.add_argument("--not-authorized-rate", type=float, default=0.0, help="rate of 102001 responses")
+    parser.add_argument("--not-found-rate", type=float, default=0.0, help="rate of 212017 orderdata responses")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="rate of HTTP 503 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="rate of HTTP 429 responses")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockStepn(
+        pages=args.pages,
+        latency=args.latency,
+        churn=args.churn,
+        not_authorized_rate=args.not_authorized_rate,
+        not_found_rate=args.not_found_rate,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        seed=args.seed,
+    )
+    web.run_app(mock.app(), host=args.host, port=args.port)
@@ -0,0 +1,124 @@
+import json
+from array import array
+
+try:
+    # Optional faster JSON decoder, the standard one is used without it
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Fields scaled like StepnRequest.reduce_price does, the rule conditions compare the scaled values
+scaled_fields = {
+    "sellPrice": 100,
+}
+
+# Fields of an orderlist row, see StepnRequest.get_orderlist
+order_fields = (
+    "id", "otd", "time", "propID", "img", "dataID", "sellPrice", "hp", "level", "quality", "mint", "addRatio",
+    "lifeRatio", "v1", "v2", "speedMax", "speedMin",
+)
+
+# Fields of the order details, see StepnRequest.get_orderdata
+detail_fields = (
+    "id", "state", "type", "dataID", "chain", "level", "quality", "hp", "speedMin", "speedMax", "breed", "otd",
+    "shoeImg", "lifeRatio",
+)
+
+
+def scaled_value(row, field):
+    """Value of the field as the rule conditions see it, without changing the row"""
+    value = row.get(field)
+    if value is not None and field in scaled_fields:
+        return int(value) / scaled_fields[field]
+    return value
+
+
+class Record(object):
+    """
+    Read-only record with one slot per known field, and the `get` and `[]` lookups of the dict it is built from.
+    Unknown fields of the API are kept in `extra`, which stays None when there are none.
+    """
+
+    __slots__ = ("extra",)
+    fields = ()
+
+    def __init__(self, item):
+        for field in self.fields:
+            setattr(self, field, item.get(field))
+
+        self.extra = {key: value for key, value in item.items() if key not in self.fields} or None
+
+    def get(self, field, default=None):
+        if field in self.fields:
+            value = getattr(self, field)
+        elif self.extra:
+            value = self.extra.get(field)
+        else:
+            value = None
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def to_dict(self):
+        item = {field: getattr(self, field) for field in self.fields}
+        item.update(self.extra or {})
+        return item
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, item):
+        self.__init__(item)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={self.get('id')!r})"
+
+
+class OrderRow(Record):
+    """One listing of an orderlist page, sellPrice keeps the integer price of the API"""
+
+    __slots__ = order_fields
+    fields = order_fields
+
+    @property
+    def price(self):
+        """Scaled sell price"""
+        return scaled_value(self, "sellPrice")
+
+
+class OrderDetail(Record):
+    """Details of an order, with its attrs (Efficiency, Luck, Comfort, Resilience...) as an int array"""
+
+    __slots__ = detail_fields + ("attrs",)
+    fields = detail_fields + ("attrs",)
+
+    def __init__(self, item):
+        super(OrderDetail, self).__init__(item)
+        self.attrs = array("i", item.get("attrs") or [])
+
+    def to_dict(self):
+        item = super(OrderDetail, self).to_dict()
+        item["attrs"] = list(self.attrs)
+        return item
+
+
+def decode_response(endpoint, response_json):
+    """Turns the data of the orderlist and orderdata responses into OrderRow and OrderDetail records"""
+    data = response_json.get("data")
+
+    match endpoint:
+        case "orderlist" if isinstance(data, list):
+            response_json["data"] = [OrderRow(item) for item in data]
+        case "orderdata" if isinstance(data, dict):
+            response_json["data"] = OrderDetail(data)
+
+    return response_json
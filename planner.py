@@ -0,0 +1,90 @@
+import asyncio
+from collections import Counter
+
+from stepn_async import AsyncStepnRequest
+
+
+def orderlist_key(params):
+    """Effective get_orderlist params, the same for two rules fetching the same pages"""
+    return tuple(sorted((key, str(value)) for key, value in params.items() if value not in (None, "")))
+
+
+def plan(rules):
+    """Groups the rules by their effective get_orderlist requests, the page excluded"""
+    def unsplit_key(rule):
+        return orderlist_key({key: value for key, value in rule.unsplit_params.items() if key != "page"})
+
+    # A split rule whose unsplit pages are fetched for another rule anyway reads them too instead
+    unsplit_keys = Counter(unsplit_key(rule) for rule in rules)
+    for rule in rules:
+        if len(rule.requests) > 1 and unsplit_keys[unsplit_key(rule)] > 1:
+            rule.unsplit()
+
+    groups = {}
+    for rule in rules:
+        requests = tuple(
+            orderlist_key({key: value for key, value in params.items() if key != "page"}) for params in rule.requests
+        )
+        groups.setdefault(requests, []).append(rule)
+
+    print(f"{len(rules)} rules on {len(groups)} distinct orderlists")
+    return groups
+
+
+class SharedOrderlist(object):
+    """
+    StepnRequest wrapper for one sweep: each distinct (params, page) orderlist is only fetched once and the response is
+    shared by every rule asking for it. Every other call goes to the wrapped client.
+    """
+
+    def __init__(self, stepn):
+        self.stepn = stepn
+        self.responses = {}
+
+        self.requests = 0
+        self.shared = 0
+
+    def __getattr__(self, name):
+        return getattr(self.stepn, name)
+
+    def get_orderlist(self, **kwargs):
+        key = orderlist_key(kwargs)
+
+        if key in self.responses:
+            self.shared += 1
+        else:
+            self.requests += 1
+            self.responses[key] = self.stepn.get_orderlist(**kwargs)
+
+        return self.responses[key]
+
+    def release(self):
+        """Forget the fetched pages, once every rule needing them is checked"""
+        self.responses.clear()
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "shared": self.shared,
+        }
+
+
+class AsyncSharedOrderlist(SharedOrderlist):
+    """
+    SharedOrderlist for AsyncStepnRequest, concurrent rules asking for the same page wait for the same request.
+    """
+
+    iter_orderlist_pages = AsyncStepnRequest.iter_orderlist_pages
+    get_orderlist_pages = AsyncStepnRequest.get_orderlist_pages
+
+    async def get_orderlist(self, **kwargs):
+        key = orderlist_key(kwargs)
+
+        if key in self.responses:
+            self.shared += 1
+        else:
+            self.requests += 1
+            self.responses[key] = asyncio.ensure_future(self.stepn.get_orderlist(**kwargs))
+
+        # Cancelling one rule must not cancel the request other rules wait for
+        return await asyncio.shield(self.responses[key])
@@ -0,0 +1,148 @@
+import random
+import time
+from collections import deque
+
+
+class RetryBudget(object):
+    """Retries allowed within the last `window` seconds: `minimum` plus `ratio` of the requests sent"""
+
+    def __init__(self, ratio=0.2, minimum=10, window=60):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+
+        self.requests = deque()
+        self.retries = deque()
+
+    def expire(self, now):
+        for events in (self.requests, self.retries):
+            while events and events[0] <= now - self.window:
+                events.popleft()
+
+    def request(self, now):
+        self.requests.append(now)
+
+    def withdraw(self, now):
+        """Spends one retry, False when the budget is exhausted"""
+        self.expire(now)
+        if len(self.retries) >= self.minimum + self.ratio * len(self.requests):
+            return False
+        self.retries.append(now)
+        return True
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` retryable failures in a row, every request then fails at once for `reset_timeout`
+    seconds. One trial request is let through afterwards: its success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial else "open"
+
+    def allow(self, now):
+        if self.opened_at is None:
+            return True
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # The next requests wait for the trial, up to another reset_timeout
+        self.opened_at = now
+        self.trial = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self, now):
+        self.failures += 1
+        if self.trial or self.failures >= self.threshold:
+            self.opened_at = now
+            self.trial = False
+
+
+class RetryPolicy(object):
+    """
+    Retries of the failed Stepn requests, shared by the sync and async clients.
+
+    A request failing with a retryable error is sent up to `attempts` times, each retry after a full jitter exponential
+    backoff: a random delay between 0 and `base_delay * 2 ** attempt`, capped at `max_delay`, so that clients failing
+    together don't retry together. Each endpoint has its own RetryBudget, bounding the extra load when the API is
+    down, and its own CircuitBreaker, so that a failing endpoint fails fast without holding the rules of the other
+    endpoints. StepnAttempt applies it to the requests of both clients.
+    """
+
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=30, budget_ratio=0.2, budget_minimum=10,
+                 breaker_threshold=5, breaker_timeout=60):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_minimum = budget_minimum
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+
+        self.budgets = {}
+        self.breakers = {}
+
+    def budget(self, endpoint):
+        if endpoint not in self.budgets:
+            self.budgets[endpoint] = RetryBudget(ratio=self.budget_ratio, minimum=self.budget_minimum)
+        return self.budgets[endpoint]
+
+    def breaker(self, endpoint):
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(threshold=self.breaker_threshold,
+                                                     reset_timeout=self.breaker_timeout)
+        return self.breakers[endpoint]
+
+    def allow(self, endpoint, attempt=0):
+        """False while the breaker of the endpoint is open, first attempts count in its retry budget"""
+        now = time.monotonic()
+        if not self.breaker(endpoint).allow(now):
+            return False
+        if attempt == 0:
+            self.budget(endpoint).request(now)
+        return True
+
+    def success(self, endpoint):
+        self.breaker(endpoint).success()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def failure(self, endpoint, retryable, attempt):
+        """Seconds to wait before the next attempt, None when the failure is final"""
+        if not retryable:
+            # The endpoint answered, e.g. an unknown code caused by the params of one rule only
+            self.success(endpoint)
+            return None
+
+        now = time.monotonic()
+        self.breaker(endpoint).failure(now)
+
+        if attempt + 1 >= self.attempts:
+            return None
+        if not self.breaker(endpoint).allow(now) or not self.budget(endpoint).withdraw(now):
+            return None
+        return self.backoff(attempt)
+
+    def stats(self):
+        return {endpoint: breaker.state for endpoint, breaker in self.breakers.items()}
+
+    def reset(self):
+        """Forgets the budgets and breakers of every endpoint"""
+        self.budgets.clear()
+        self.breakers.clear()
@@ -0,0 +1,408 @@
+import ast
+import functools
+import hashlib
+import itertools
+import json
+import math
+import operator
+import re
+
+from models import scaled_value
+from stepn import StepnRequest, mapping_chain_reversed, mapping_response_attrs_reversed, mapping_order, \
+    orderlist_page_size
+
+# `%sellPrice`, `%level`, `%attr.Luck`...
+binded_var = re.compile(r"%(\w+(?:\.\w+)?)")
+
+operators = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+# Reversed comparison for `constant < %var` written as `%var > constant`
+swapped_operators = {
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+}
+
+# Bounds of the sell price which can't be met by any later page, by order of the orderlist
+monotonic_operators = {
+    mapping_order["lowest_price"]: (ast.Lt, ast.LtE),
+    mapping_order["highest_price"]: (ast.Gt, ast.GtE),
+}
+
+# Row fields which can be filtered by the orderlist server: param name and possible values
+pushdown_fields = {
+    "quality": ("quality", range(1, 6)),
+    "level": ("level", range(0, 31)),
+    "mint": ("bread", range(0, 8)),
+}
+
+# Maximum number of orderlist requests a rule can be split into by the pushdown
+PUSHDOWN_MAX_SPLITS = 4
+
+class RuleError(Exception):
+    """ Raised when a rule can't be compiled"""
+
+    def __init__(self, message="Invalid rule"):
+        super(RuleError, self).__init__(message)
+        self.message = message
+
+
+def row_getter(var):
+    if var.startswith("attr."):
+        raise RuleError(f"%{var} is only available in conditions_on_stats")
+    if "." in var:
+        raise RuleError(f"Unknown var %{var}")
+    return lambda row: scaled_value(row, var)
+
+
+def details_getter(var):
+    if var.startswith("attr."):
+        attr = var.split("attr.")[1]
+        if attr not in mapping_response_attrs_reversed:
+            raise RuleError(f"Unknown attribute %{var}, expected one of {list(mapping_response_attrs_reversed)}")
+        return lambda details: StepnRequest.get_orderdata_attrs(details, attr)
+    if "." in var:
+        raise RuleError(f"Unknown var %{var}")
+    return lambda details: details.get('data').get(var)
+
+
+def compile_node(node, getters):
+    """Turns a whitelisted expression node into a function of the row"""
+    match node:
+        case ast.Expression(body=body):
+            return compile_node(body, getters)
+        case ast.Constant(value=value):
+            return lambda row: value
+        case ast.Name(id=name) if name in getters:
+            return getters[name]
+        case ast.Tuple(elts=elts) | ast.List(elts=elts) | ast.Set(elts=elts):
+            functions = [compile_node(elt, getters) for elt in elts]
+            return lambda row: tuple(function(row) for function in functions)
+        case ast.BoolOp(op=ast.And(), values=values):
+            functions = [compile_node(value, getters) for value in values]
+            return lambda row: all(function(row) for function in functions)
+        case ast.BoolOp(op=ast.Or(), values=values):
+            functions = [compile_node(value, getters) for value in values]
+            return lambda row: any(function(row) for function in functions)
+        case ast.UnaryOp(op=op, operand=operand) if type(op) in operators:
+            function, operand = operators[type(op)], compile_node(operand, getters)
+            return lambda row: function(operand(row))
+        case ast.BinOp(op=op, left=left, right=right) if type(op) in operators:
+            function, left, right = operators[type(op)], compile_node(left, getters), compile_node(right, getters)
+            return lambda row: function(left(row), right(row))
+        case ast.Compare(left=left, ops=ops, comparators=comparators) if all(type(op) in operators for op in ops):
+            operands = [compile_node(left, getters)] + [compile_node(value, getters) for value in comparators]
+            functions = [operators[type(op)] for op in ops]
+
+            def compare(row):
+                values = [operand(row) for operand in operands]
+                return all(function(a, b) for function, a, b in zip(functions, values, values[1:]))
+
+            return compare
+
+    raise RuleError(f"Unsupported expression {ast.unparse(node)!r}")
+
+
+def parse_conditions(conditions):
+    """Returns the expression tree of the conditions and the placeholder name of each binded var"""
+    variables = {}
+
+    def placeholder(match):
+        return variables.setdefault(match.group(1), f"__var{len(variables)}")
+
+    source = binded_var.sub(placeholder, conditions)
+
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise RuleError(f"Invalid conditions {conditions!r}: {e.msg}")
+
+    return tree, variables
+
+
+def unbind_vars(source, variables):
+    """The source of a parsed expression, with the %var names back in place of their placeholders"""
+    names = {name: var for var, name in variables.items()}
+    return re.sub(r"__var\d+", lambda match: f"%{names.get(match.group(0), match.group(0))}", source)
+
+
+def compile_conditions(conditions, getter=row_getter):
+    """
+    Compile conditions like "%sellPrice < 2000000 and %quality in (3, 4)" once into a predicate of the row.
+
+    Only comparisons, boolean and arithmetic operators on literals and binded vars are allowed, anything else raises a
+    RuleError instead of being evaluated.
+    """
+    if not conditions:
+        raise RuleError("Empty conditions")
+
+    tree, variables = parse_conditions(conditions)
+
+    try:
+        getters = {name: getter(var) for var, name in variables.items()}
+        return compile_node(tree, getters)
+    except RuleError as e:
+        raise RuleError(f"Invalid conditions {conditions!r}: {unbind_vars(e.message, variables)}")
+
+
+def conjuncts_of(tree):
+    body = tree.body
+    return body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+
+
+def names_of(node):
+    return {child.id for child in ast.walk(node) if isinstance(child, ast.Name)}
+
+
+def find_bounds(conditions, var):
+    """
+    Returns the (operator, value) bounds the var must meet whatever the rest of the conditions,
+    e.g. [(ast.Lt, 2000000)] for "%sellPrice < 2000000 and %level > 5"
+    """
+    if not conditions:
+        return []
+
+    tree, variables = parse_conditions(conditions)
+    if var not in variables:
+        return []
+
+    bounds = []
+    for node in conjuncts_of(tree):
+        if not isinstance(node, ast.Compare):
+            continue
+
+        operands = [node.left] + node.comparators
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            if type(op) not in swapped_operators:
+                continue
+            if isinstance(left, ast.Name) and left.id == variables[var] and isinstance(right, ast.Constant):
+                bounds.append((type(op), right.value))
+            elif isinstance(right, ast.Name) and right.id == variables[var] and isinstance(left, ast.Constant):
+                bounds.append((swapped_operators[type(op)], left.value))
+
+    return bounds
+
+
+def find_pushdown(conditions, params, pages=1, max_splits=PUSHDOWN_MAX_SPLITS):
+    """
+    Move the conditions on the fields filtered by the orderlist server into the request params.
+
+    A top-level condition on a single pushable field, e.g. "%quality in (3, 4)" or "%level >= 28", is replaced by
+    one request for each value it allows. The listings are expected to be spread evenly over the values of a field, so
+    a request for one of the 5 qualities reaches as deep in the orderlist in `pages / 5` pages as the unfiltered request
+    in `pages` pages. A field is pushed as long as the rule isn't split into more than max_splits requests, and the
+    split requests fetch fewer pages than the unfiltered one. A field with a single allowed value is always pushed.
+    Returns the list of request params, the pages of each request and the conditions left to check on the rows.
+    """
+    tree, variables = parse_conditions(conditions)
+    names = {name: var for var, name in variables.items()}
+
+    # field -> (allowed values, conditions nodes)
+    constraints = {}
+    residual = []
+    for node in conjuncts_of(tree):
+        node_names = names_of(node)
+        var = names.get(next(iter(node_names))) if len(node_names) == 1 else None
+
+        if var in pushdown_fields and not params.get(pushdown_fields[var][0]):
+            try:
+                predicate = compile_node(node, {variables[var]: lambda row: row.get(var)})
+                allowed = {value for value in pushdown_fields[var][1] if predicate({var: value})}
+            except (RuleError, TypeError):
+                residual.append(node)
+                continue
+
+            values, nodes = constraints.get(var, (set(pushdown_fields[var][1]), []))
+            constraints[var] = (values & allowed, nodes + [node])
+        else:
+            residual.append(node)
+
+    # The most selective fields are pushed first
+    pushed = {}
+    splits = spread = 1
+    request_pages = pages
+    for var, (values, nodes) in sorted(constraints.items(), key=lambda constraint: len(constraint[1][0])):
+        field_splits, field_spread = splits * len(values), spread * len(pushdown_fields[var][1])
+        field_pages = math.ceil(pages / field_spread)
+
+        if values and field_splits <= max_splits and (field_splits == 1 or field_splits * field_pages < pages):
+            pushed[var] = sorted(values)
+            splits, spread, request_pages = field_splits, field_spread, field_pages
+        else:
+            residual.extend(nodes)
+
+    if not pushed:
+        return [params], pages, conditions
+
+    requests = [
+        {**params, **{pushdown_fields[var][0]: value for var, value in zip(pushed, combination)}}
+        for combination in itertools.product(*pushed.values())
+    ]
+
+    residual_conditions = " and ".join(f"({ast.unparse(node)})" for node in residual) if residual else "True"
+    residual_conditions = unbind_vars(residual_conditions, variables)
+
+    return requests, request_pages, residual_conditions
+
+
+def watermark_key(row):
+    """Position of a row in the latest order, the newest listing has the highest key"""
+    return row.get('time') or 0, row.get('id') or 0
+
+
+class Rule(object):
+    """One item of secrets.RULES with its conditions compiled"""
+
+    def __init__(self, item):
+        self.item = item
+
+        self.title = item.get("title") if item.get("title") else ''
+        self.params = item["params"]
+        self.page_end = item["page_end"]
+        self.limit = item.get("limit", 1000)
+        self.price = item.get("price")
+        self.threshold = item.get("threshold")
+        # Seconds of floor prices averaged as the price limit, instead of the last match
+        self.baseline_window = item.get("baseline_window")
+        self.image_enabled = item.get("image_enabled")
+
+        # Stable id of the rule between runs, changing its settings makes it a new rule but a new price limit doesn't
+        settings = {key: value for key, value in item.items() if key != "price"}
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+        self.key = f"{self.title}#{digest[:8]}"
+
+        try:
+            self.chain = mapping_chain_reversed[self.params.get('chain')]
+            self.pushdown()
+            self.conditions_on_stats = None
+            if item.get("conditions_on_stats"):
+                self.conditions_on_stats = compile_conditions(item["conditions_on_stats"], getter=details_getter)
+        except KeyError as e:
+            raise RuleError(f"Rule {self.title!r}: unknown chain {e}")
+        except RuleError as e:
+            raise RuleError(f"Rule {self.title!r}: {e.message}")
+
+        # Newest listing of the last complete sweep of a `latest` rule, kept as long as the process runs (daemon.py)
+        self.watermark = None
+        # Newest listing of the sweep in progress, the watermark once every listing of the sweep is evaluated
+        self.next_watermark = None
+        # Listings not seen before by the checks of the rule, read by the scheduler
+        self.new_listings = 0
+
+    def __repr__(self):
+        return f"Rule({self.title!r})"
+
+    def pushdown(self, max_splits=PUSHDOWN_MAX_SPLITS):
+        """Compiles the conditions left once the ones the server can filter are moved into the orderlist requests"""
+        conditions = self.item.get("conditions")
+        pages = self.page_end - self.params.get("page", 0) + 1
+
+        # Orderlist requests of the rule, several when the pushdown split it
+        self.requests = [self.params]
+        # Its single request when it isn't split, see planner.plan
+        self.unsplit_params = self.params
+        # Last page of each request, the pushed requests reach as deep as page_end in fewer pages
+        self.request_page_end = self.page_end
+        if self.item.get("pushdown", True) and conditions:
+            (self.unsplit_params,), _, _ = find_pushdown(conditions, self.params, pages=pages, max_splits=1)
+            self.requests, request_pages, conditions = find_pushdown(
+                conditions, self.params, pages=pages, max_splits=max_splits
+            )
+            self.request_page_end = self.params.get("page", 0) + request_pages - 1
+
+        self.conditions = compile_conditions(conditions)
+        # Conditions checked on the rows, compiled again by batch_conditions on its next use
+        self.row_conditions = conditions
+        self.__dict__.pop("batch_conditions", None)
+        self.price_bounds = [
+            (op, value) for op, value in find_bounds(conditions, "sellPrice")
+            if op in monotonic_operators.get(self.params.get("order"), ())
+        ]
+
+    @functools.cached_property
+    def batch_conditions(self):
+        """The row conditions compiled for batch.filter_rows on first use, None when numpy can't evaluate them"""
+        # numpy is only imported by the runs in batch mode
+        from batch import compile_batch_conditions
+
+        try:
+            return compile_batch_conditions(self.row_conditions)
+        except RuleError:
+            # Valid row conditions numpy can't evaluate on whole pages, e.g. "%level in (%mint, 5)", check every row
+            return None
+
+    def unsplit(self):
+        """Checks the rule on its single unsplit request again, e.g. to share its pages with other rules"""
+        if len(self.requests) > 1:
+            self.pushdown(max_splits=1)
+
+    def order_key(self, row):
+        """Sort key of the rows in the server order, to merge the rows of several requests"""
+        match self.params.get("order"):
+            case order if order == mapping_order["lowest_price"]:
+                return row.get('sellPrice') or 0
+            case order if order == mapping_order["highest_price"]:
+                return -(row.get('sellPrice') or 0)
+            case order if order == mapping_order["latest"]:
+                return tuple(-key for key in watermark_key(row))
+        return 0
+
+    def is_exhausted(self, rows, watermark=None):
+        """
+        True when no page after these rows can match: the server has no more rows, sorted the prices past the
+        conditions bounds, or the latest listings are already older than the watermark of the previous sweep.
+        """
+        # A page which isn't full is the last one
+        if len(rows) < orderlist_page_size:
+            return True
+
+        last = rows[-1]
+
+        if self.price_bounds and last.get('sellPrice') is not None:
+            price = StepnRequest.reduce_price(last['sellPrice'])
+            if not all(operators[op](price, value) for op, value in self.price_bounds):
+                return True
+
+        if self.params.get("order") == mapping_order["latest"] and watermark is not None:
+            return watermark_key(last) <= watermark
+
+        return False
+
+    def observe_watermark(self, rows):
+        if self.params.get("order") == mapping_order["latest"] and rows:
+            newest = max(watermark_key(row) for row in rows)
+            self.next_watermark = max(self.next_watermark, newest) if self.next_watermark else newest
+
+    def advance_watermark(self, complete):
+        """
+        Ends the sweep, the next one stops at its newest listing when it is complete. A sweep stopped early keeps the
+        watermark where it was, the listings it didn't evaluate are older than its newest one.
+        """
+        if complete and self.next_watermark:
+            self.watermark = max(self.watermark, self.next_watermark) if self.watermark else self.next_watermark
+        self.next_watermark = None
+
+
+def compile_rules(rules):
+    """Compile every rule, raises a RuleError on the first invalid one"""
+    return [Rule(item) for item in rules]
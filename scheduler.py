@@ -0,0 +1,93 @@
+import heapq
+import itertools
+import time
+from collections import deque
+
+
+def request_cost(rule):
+    """Most orderlist requests one check of the rule can send"""
+    return sum(rule.request_page_end - params.get("page", 0) + 1 for params in rule.requests)
+
+
+class RuleScheduler(object):
+    """
+    Priority queue of the rules by their next check time.
+
+    The interval of a rule is halved after a check finding new listings (new order ids or new prices) or matches, and
+    grows by half after a quiet one, within `min_interval` and `max_interval` (or the "min_interval" and
+    "max_interval" of the rule). With a `budget`, the orderlist requests of the checks started within a minute stay
+    under it: a rule over budget waits for the oldest checks to leave the window.
+    """
+
+    def __init__(self, rules, interval=60, min_interval=10, max_interval=600, budget=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+
+        self.intervals = {rule.key: self.bounds(rule, interval) for rule in rules}
+        self.checked = set()
+        self.counter = itertools.count()
+        # (next check time, tie breaker, rule)
+        self.queue = [(0, next(self.counter), rule) for rule in rules]
+        heapq.heapify(self.queue)
+
+        # (started_at, cost) of the checks of the last minute
+        self.spent = deque()
+
+    def bounds(self, rule, interval):
+        low = rule.item.get("min_interval", self.min_interval)
+        high = rule.item.get("max_interval", self.max_interval)
+        return min(max(interval, low), high)
+
+    def spent_budget(self, now):
+        while self.spent and self.spent[0][0] <= now - 60:
+            self.spent.popleft()
+        return sum(cost for _, cost in self.spent)
+
+    def due(self, now=None, slack=0):
+        """Pops the rules to check now, `slack` seconds early so that rules due together share their pages"""
+        now = now or time.time()
+        rules = []
+        postponed = []
+
+        while self.queue and self.queue[0][0] <= now + slack:
+            next_at, tie, rule = heapq.heappop(self.queue)
+            cost = request_cost(rule)
+
+            if self.budget and self.spent_budget(now) + cost > self.budget and (self.spent or rules):
+                # Retried once the oldest check leaves the window
+                retry_at = self.spent[0][0] + 60 if self.spent else now + 1
+                postponed.append((max(retry_at, next_at), tie, rule))
+                continue
+
+            self.spent.append((now, cost))
+            rules.append(rule)
+
+        for entry in postponed:
+            heapq.heappush(self.queue, entry)
+
+        return rules
+
+    def observe(self, rule, new_listings, matches, now=None):
+        """Reschedules a checked rule from the listings its check found changed"""
+        now = now or time.time()
+        interval = self.intervals[rule.key]
+
+        if rule.key not in self.checked:
+            # Every listing is new to the first check
+            self.checked.add(rule.key)
+        elif new_listings or matches:
+            interval /= 2
+        else:
+            interval *= 1.5
+
+        interval = self.intervals[rule.key] = self.bounds(rule, interval)
+        heapq.heappush(self.queue, (now + interval, next(self.counter), rule))
+
+    def wait(self, now=None):
+        """Seconds before the next rule is due"""
+        now = now or time.time()
+        return max(0, self.queue[0][0] - now) if self.queue else self.max_interval
+
+    def stats(self):
+        return {rule.title: round(self.intervals[rule.key], 1) for _, _, rule in self.queue}
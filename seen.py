@@ -0,0 +1,77 @@
+import pickle
+import time
+
+
+def listing_key(row, price=None):
+    """
+    Hash of the listing: the same order at another price is a new listing, and so is the same listing evaluated
+    against another price limit
+    """
+    return hash((row.get('id'), row.get('sellPrice'), price))
+
+
+class SeenIndex(object):
+    """
+    Listings (order id, sell price, price limit of the rule) already evaluated by each rule.
+
+    Each rule keeps two generations of listing hashes: a listing is seen if it is in one of them, and the older one is
+    dropped every `ttl` seconds or as soon as the current one holds `maxsize` listings. A listing is so forgotten
+    after `ttl` to `2 * ttl` seconds, and a rule never holds more than `2 * maxsize` hashes.
+    With a filename the index is kept between runs.
+    """
+
+    def __init__(self, ttl=86400, maxsize=50000, filename=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.filename = filename
+
+        # rule key -> [started_at, current generation, previous generation]
+        self.generations = {}
+
+        self.skipped = 0
+
+        if self.filename:
+            self.load()
+
+    def generation(self, rule_key):
+        generation = self.generations.get(rule_key)
+
+        if not generation:
+            generation = self.generations[rule_key] = [time.time(), set(), set()]
+        elif generation[0] + self.ttl < time.time() or len(generation[1]) >= self.maxsize:
+            generation[:] = [time.time(), set(), generation[1]]
+
+        return generation
+
+    def seen(self, rule_key, row, price=None):
+        _, current, previous = self.generation(rule_key)
+        key = listing_key(row, price)
+
+        if key in current or key in previous:
+            self.skipped += 1
+            return True
+        return False
+
+    def add(self, rule_key, row, price=None):
+        self.generation(rule_key)[1].add(listing_key(row, price))
+
+    def stats(self):
+        return {
+            "rules": len(self.generations),
+            "listings": sum(len(current) + len(previous) for _, current, previous in self.generations.values()),
+            "skipped": self.skipped,
+        }
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                self.generations = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return
+
+    def save(self):
+        if not self.filename:
+            return
+
+        with open(self.filename, 'wb') as f:
+            pickle.dump(self.generations, f)
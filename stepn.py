@@ -1,11 +1,15 @@
+import itertools
 import pickle
 import time
 from datetime import datetime
 from functools import wraps
 
-import pyotp
 import requests
-import stepn_password
+
+from logger import logger
+from metrics import registry, size_buckets
+from models import decode_response, loads, scaled_value
+from retry import RetryPolicy
 
 url_front = "https://m.stepn.com"
 url_api = "https://api.stepn.com/run"
@@ -23,6 +27,9 @@ params_orderlist = [
     "bread",  # Number of mints
 ]
 
+# Number of rows of an orderlist page
+orderlist_page_size = 60
+
 mapping_chain = {
     "sol": 103,
     "bnb": 104,
@@ -117,47 +124,231 @@ class StepnNotAuthorized(Exception):
         self.message = message
 
 
+class StepnError(Exception):
+    """ Raised on the other stepn codes and on the network errors, the request can be sent again when retryable"""
+
+    def __init__(self, message="Stepn request failed", code=None, retryable=False):
+        self.message = message
+        self.code = code
+        self.retryable = retryable
+
+
+class StepnThrottled(StepnError):
+    """ Raised on HTTP 429 and on the throttling_codes"""
+
+    def __init__(self, message="Too many requests", code=429):
+        super(StepnThrottled, self).__init__(message, code=code, retryable=True)
+
+
+class StepnCircuitOpen(StepnError):
+    """ Raised without sending the request while the endpoint is paused by its circuit breaker"""
+
+    def __init__(self, message="Endpoint paused after repeated failures"):
+        super(StepnCircuitOpen, self).__init__(message)
+
+
+# Stepn codes answered when the requests are too frequent, retried like HTTP 429 once the limiter slowed down
+throttling_codes = set()
+
+
+def check_http_status(status):
+    """Raises the retryable errors of the HTTP statuses answered without a stepn json"""
+    if status == 429:
+        raise StepnThrottled()
+    if status >= 500:
+        raise StepnError(f"HTTP {status}", code=status, retryable=True)
+
+
+def check_response_json(response_json):
+    """Returns the json when the stepn code is a success, raises the matching exception otherwise"""
+    match response_json.get('code'):
+        case 0:
+            return response_json
+        case 102001:
+            print(response_json)
+            print("NotAuthorized")
+            raise StepnNotAuthorized()
+        case 212017:
+            print("NotFound")
+            raise StepnNotFound()
+        case code if code in throttling_codes:
+            raise StepnThrottled(response_json.get('msg'), code=code)
+
+    if response_json.get('code'):
+        raise StepnError(response_json.get('msg'), code=response_json.get('code'))
+
+
+def record_response(endpoint, response_json):
+    """Counts the stepn codes of the endpoint, then check_response_json and decode the rows of the response"""
+    registry.inc("stepn_responses_total", endpoint=endpoint, code=response_json.get('code'))
+    return decode_response(endpoint, check_response_json(response_json))
+
+
+def read_response(endpoint, url, status, body, latency):
+    """
+    Logs, measures and archives the response of either client, then returns its decoded json or raises the StepnError
+    of its HTTP status, of an invalid body or of its stepn code
+    """
+    logger.log(endpoint=endpoint, url=url, latency=latency, status=status)
+
+    registry.inc("stepn_requests_total", endpoint=endpoint)
+    registry.observe("stepn_request_seconds", latency, endpoint=endpoint)
+    registry.observe("stepn_response_bytes", len(body), buckets=size_buckets, endpoint=endpoint)
+
+    check_http_status(status)
+
+    with registry.timer("stepn_decode_seconds", endpoint=endpoint):
+        try:
+            response_json = loads(body)
+        except ValueError as e:
+            raise StepnError(f"Invalid response: {e}", retryable=True) from e
+
+    # Only the successes are replayed, a retried or expired session response would fail the backtest
+    if StepnRequest.archive and response_json.get('code') == 0:
+        StepnRequest.archive.record(endpoint, url, response_json)
+
+    return record_response(endpoint, response_json)
+
+
+class StepnAttempt(object):
+    """
+    One attempt of a request under the StepnRequest.retry_policy, for both the sync and async watchers:
+
+        for number in itertools.count():
+            with StepnAttempt(endpoint, number, limiter) as attempt:
+                return send()
+            sleep(attempt.delay)
+
+    Entering raises StepnCircuitOpen while the endpoint is paused. A failure which can be retried is suppressed and
+    leaves the delay to wait before the next attempt, any other is raised. The limiter (slow_down and speed_up) of the
+    client is slowed down by the throttled responses and sped up again by the successes.
+    """
+
+    def __init__(self, endpoint, number, limiter):
+        self.endpoint = endpoint
+        self.number = number
+        self.limiter = limiter
+        self.delay = None
+
+    def __enter__(self):
+        if not StepnRequest.retry_policy.allow(self.endpoint, self.number):
+            registry.inc("stepn_circuit_open_total", endpoint=self.endpoint)
+            raise StepnCircuitOpen()
+        return self
+
+    def __exit__(self, exc_type, error, traceback):
+        policy = StepnRequest.retry_policy
+
+        if exc_type is None:
+            policy.success(self.endpoint)
+            self.limiter.speed_up()
+            return False
+        if issubclass(exc_type, StepnNotFound):
+            # The endpoint answered
+            policy.success(self.endpoint)
+            return False
+        if not issubclass(exc_type, StepnError):
+            return False
+
+        registry.inc("stepn_failures_total", endpoint=self.endpoint, code=error.code)
+        if isinstance(error, StepnThrottled):
+            self.limiter.slow_down()
+
+        self.delay = policy.failure(self.endpoint, error.retryable, self.number)
+        if self.delay is None:
+            return False
+
+        print(f"{self.endpoint} failed ({error.message}), retry in {self.delay:.2f}s")
+        registry.inc("stepn_retries_total", endpoint=self.endpoint)
+        return True
+
+
 def http_stepn_watcher(function):
-    @wraps(function)
-    def _http_stepn_watcher(*args, **kwargs):
+    endpoint = function.__name__.removeprefix("get_")
+
+    def call(self, *args, **kwargs):
+        # Slowed down after the throttled responses
+        if self.throttle_delay:
+            time.sleep(self.throttle_delay)
+
         try:
-            response = function(*args, **kwargs)
-
-            response_json = response.json()
-            match response_json.get('code'):
-                case 0:
-                    return response_json
-                case 102001:
-                    print(response, response_json)
-                    print("NotAuthorized")
-                    raise StepnNotAuthorized()
-                case 212017:
-                    print("NotFound")
-                    raise StepnNotFound()
-
-            if response_json.get('code'):
-                raise Exception(response_json.get('code'), response_json.get('msg'))
-
-        except Exception as e:
-            raise e
+            response = function(self, *args, **kwargs)
+        except requests.RequestException as e:
+            raise StepnError(repr(e), retryable=True) from e
+
+        response_json = read_response(
+            endpoint, response.url, response.status_code, response.content, response.elapsed.total_seconds()
+        )
+        # Any success proves the session is still valid
+        self.validated_at = time.time()
+        return response_json
+
+    def call_logged_in(self, *args, **kwargs):
+        try:
+            return call(self, *args, **kwargs)
+        except StepnNotAuthorized:
+            if endpoint in ("login", "userbasic"):
+                raise
+            # The trusted session expired, log in again once and replay the call
+            with registry.timer("stepn_login_seconds"):
+                self.get_login()
+            return call(self, *args, **kwargs)
+
+    @wraps(function)
+    def _http_stepn_watcher(self, *args, **kwargs):
+        for number in itertools.count():
+            with StepnAttempt(endpoint, number, limiter=self) as attempt:
+                return call_logged_in(self, *args, **kwargs)
+            time.sleep(attempt.delay)
 
     return _http_stepn_watcher
 
 
+def build_url(endpoint, **kwargs) -> str:
+    url = f"{url_api}/{endpoint}?"
+
+    for i, (key, value) in enumerate(kwargs.items()):
+        if i > 0:
+            url = f"{url}&"
+
+        url = f"{url}{key}={value}"
+
+    return url
+
+
 class StepnRequest(object):
-    session = requests.session()
+    session: requests.Session
+
+    # Seconds waited before each request to avoid the rate limits
+    rate_limit_delay = 1
+    # Seconds a session validated by a successful request is trusted without checking it again
+    session_ttl = 600
+    # ResponseArchive recording the orderlist and orderdata responses of every client, when set
+    archive = None
+    # Retries, retry budgets and circuit breakers of the endpoints, shared by every client
+    retry_policy = RetryPolicy()
+    # Extra seconds waited before each request while the API throttles, up to max_throttle_delay
+    throttle_delay = 0
+    max_throttle_delay = 30
 
     __email: str
     __password: str
     __google_2auth_secret: str
 
     sessionID = None
+    validated_at = 0
 
-    def __init__(self, email, password, google_2auth_secret=None):
+    def __init__(self, email, password, google_2auth_secret=None, cookies_filename='cookies', timeout=30):
         self.__email = email
         self.__password = password
         self.__google_2auth_secret = google_2auth_secret
 
+        # Every account has its own session and cookies file
+        self.session = requests.session()
+        self.cookies_filename = cookies_filename
+        # Seconds before a stalled request fails and is retried
+        self.timeout = timeout
+
         attempt = 3
         success = False
         while attempt > 0:
@@ -169,10 +360,16 @@ class StepnRequest(object):
         if not success:
             raise Exception('Impossible to ensure_connection')
 
+        self.save_cookies()
+
     def ensure_connection(self):
         if not self.session.cookies:
             self.load_cookies()
 
+        # A cold start right after another run skips the round-trip
+        if self.sessionID and self.validated_at + self.session_ttl > time.time():
+            return True
+
         try:
             response = self.get_userbasic()
 
@@ -180,21 +377,44 @@ class StepnRequest(object):
                 return True
             else:
                 raise ConnectionError
-        except ConnectionError:
-            self.get_login()
-        except StepnNotAuthorized:
-            self.get_login()
+        except (ConnectionError, StepnNotAuthorized):
+            with registry.timer("stepn_login_seconds"):
+                self.get_login()
+
+    def slow_down(self):
+        """Doubles the extra delay of the requests after a throttled response"""
+        self.throttle_delay = min(max(self.throttle_delay * 2, 0.5), self.max_throttle_delay)
+
+    def speed_up(self):
+        """Shortens the extra delay after a success, until it is gone"""
+        self.throttle_delay = self.throttle_delay * 0.9 if self.throttle_delay > 0.1 else 0
 
     def load_cookies(self):
         try:
-            with open('cookies', 'rb') as f:
-                self.session.cookies.update(pickle.load(f))
-                self.sessionID = self.session.cookies.get('sessionID')
-        except FileNotFoundError:
+            with open(self.cookies_filename, 'rb') as f:
+                saved = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
             return
 
+        # Files saved before the validation time was kept only hold the cookies
+        if isinstance(saved, dict) and "cookies" in saved:
+            self.session.cookies.update(saved["cookies"])
+            self.validated_at = saved.get("validated_at", 0)
+        else:
+            self.session.cookies.update(saved)
+        self.sessionID = self.session.cookies.get('sessionID')
+
+    def save_cookies(self):
+        """Saves the cookies with the time the session was last validated"""
+        with open(self.cookies_filename, 'wb') as f:
+            pickle.dump({"cookies": self.session.cookies, "validated_at": self.validated_at}, f)
+
     @http_stepn_watcher
     def get_login(self, ):
+        # Only imported by the runs which need to log in
+        import pyotp
+        import stepn_password
+
         encoded_password = stepn_password.hash_password(self.__email, self.__password)
 
         google_2auth_code = pyotp.TOTP(self.__google_2auth_secret).at(datetime.now())
@@ -207,7 +427,7 @@ class StepnRequest(object):
             deviceInfo="web"
         )
 
-        response = self.session.get(url)
+        response = self.session.get(url, timeout=self.timeout)
 
         try:
             self.sessionID = response.json()["data"]['sessionID']
@@ -219,12 +439,11 @@ class StepnRequest(object):
             codeData=f'2%3A{google_2auth_code}',
             sessionID=self.sessionID
         )
-        response = self.session.get(url)
+        response = self.session.get(url, timeout=self.timeout)
 
         self.session.cookies.set("sessionID", self.sessionID)
 
-        with open('cookies', 'wb') as f:
-            pickle.dump(self.session.cookies, f)
+        self.save_cookies()
 
         return response
 
@@ -232,7 +451,7 @@ class StepnRequest(object):
     def get_userbasic(self):
         url = self.creates_url_params(endpoint='userbasic', sessionID=self.sessionID)
 
-        response = self.session.get(url)
+        response = self.session.get(url, timeout=self.timeout)
 
         return response
 
@@ -256,7 +475,7 @@ class StepnRequest(object):
         """
         url = self.creates_url_params(endpoint='orderlist', **kwargs, sessionID=self.sessionID)
 
-        response = self.session.get(url)
+        response = self.session.get(url, timeout=self.timeout)
         return response
 
     @http_stepn_watcher
@@ -268,7 +487,7 @@ class StepnRequest(object):
         {'id': 115399065777, 'state': 1230, 'type': 3, 'dataID': 100102, 'chain': 103, 'level': 5, 'quality': 1, 'hp': 100, 'isRun': False, 'remain': 200, 'attrs': [49, 53, 17, 57, 0, 0, 0, 0, 0, 0, 0, 0], 'endTime': 0, 'upLeveTime': 21600000, 'coolDownE': 86400000, 'canSend': False, 'price': 0, 'speedMin': 223, 'speedMax': 556, 'breed': 2, 'breedT': 1654351684873, 'otd': 500954417, 'hpLimit': 100, 'isTest': False, 'shoeImg': '25/1/m218706_f24e88887e635188bd88f65c88608a3e8854_67.png', 'lifeRatio': 10000, 'relatives': [{'type': 1, 'otd': 353098287, 'dataId': 100064, 'img': '2/44/m2186e0_8299cca7884e674dff639c9cb78855a2203d_67.png', 'shoeId': 151624525461}, {'type': 1, 'otd': 426386838, 'dataId': 100112, 'img': '27/42/m218710_4d6dff27374faafdff8885ffd755087f1268_67.png', 'shoeId': 160216503009}, {'type': 2, 'otd': 852544210, 'dataId': 100097, 'img': '35/10/m218701_88bce6f988e78842ff1fe422dcb01e8896ffd002ff_67.png', 'shoeId': 109258989309}, {'type': 2, 'otd': 535668981, 'dataId': 100102, 'img': '49/2/m218706_a7234235544dce55c3c497954b52f2223e7f_67.png', 'shoeId': 141985420321}], 'holes': [{'index': 0, 'type': 4, 'quality': 0, 'price': 1000, 'dataID': 0, 'gemId': 0, 'addv': 0, 'gAddv': 0, 'hAddv': 0}, {'index': 1, 'type': 4, 'quality': -1, 'price': 0, 'dataID': 0, 'gemId': 0, 'addv': 0, 'gAddv': 0, 'hAddv': 0}, {'index': 2, 'type': 1, 'quality': -1, 'price': 0, 'dataID': 0, 'gemId': 0, 'addv': 0, 'gAddv': 0, 'hAddv': 0}, {'index': 3, 'type': 4, 'quality': -1, 'price': 0, 'dataID': 0, 'gemId': 0, 'addv': 0, 'gAddv': 0, 'hAddv': 0}]}
         """
         url = self.creates_url_params(endpoint='orderdata', orderId=order_id, sessionID=self.sessionID)
-        response = self.session.get(url)
+        response = self.session.get(url, timeout=self.timeout)
         return response
 
     # @http_stepn_watcher
@@ -279,66 +498,27 @@ class StepnRequest(object):
     @classmethod
     def creates_url_params(cls, endpoint, **kwargs) -> str:
         # Avoid rate limits
-        time.sleep(1)
-
-        url = f"{url_api}/{endpoint}?"
+        with registry.timer("stepn_limiter_wait_seconds", endpoint=endpoint):
+            time.sleep(cls.rate_limit_delay)
 
-        for i, (key, value) in enumerate(kwargs.items()):
-            if i > 0:
-                url = f"{url}&"
+        url = build_url(endpoint, **kwargs)
 
-            url = f"{url}{key}={value}"
-
-        logs = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {url}\n"
-        with open("log.txt", "a") as log_file:
-            log_file.write(logs)
-
-        print(logs)
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {url}\n")
         return url
 
-    @classmethod
-    def replace_binded_vars(cls, conditions, row):
-        """Replace all the binding vars"""
-        if not conditions or not row:
-            return None
-
-        while "%" in conditions:
-            var_to_replace = conditions.split('%')[1].split()[0]
-            conditions = conditions.replace(f"%{var_to_replace}", f"{row.get(var_to_replace)}")
-
-        return conditions
-
     @staticmethod
     def get_orderdata_attrs(row, attr, default=0):
         index = mapping_response_attrs_reversed[attr]
         attrs = row.get('data').get('attrs')
         return attrs[index] if len(attrs) > 0 else default
 
-    @classmethod
-    def replace_detail_binded_vars(cls, conditions, row):
-        """Replace all the binding vars for the data details"""
-        while "%" in conditions:
-            var_to_replace = conditions.split('%')[1].split()[0]
-
-            if 'attr.' in var_to_replace:
-                value = var_to_replace.split('attr.')[1]
-                real_value = cls.get_orderdata_attrs(row, value)
-            else:
-                real_value = row.get(var_to_replace)
-
-            conditions = conditions.replace(f"%{var_to_replace}", str(real_value))
-
-        return conditions
-
     @staticmethod
-    def reduce_item(details: dict):
-        if 'sellPrice' in details:
-            details['sellPrice'] = int(details['sellPrice']) / 100
-        return details
+    def reduce_price(price):
+        return int(price) / 100
 
     @staticmethod
     def human_readable_stats(title: str, chain: str, details: dict):
         url = f"{url_front}/order/{details.get('id')}"
-        message = f"{title} => {details.get('sellPrice')} ${mapping_currency[chain]} - lvl {details.get('level')} - " \
+        message = f"{title} => {scaled_value(details, 'sellPrice')} ${mapping_currency[chain]} - lvl {details.get('level')} - " \
                   f"{mapping_quality_reversed[details.get('quality')]} - {details.get('mint')} mint"
         return f"{message}\n{url}\n"
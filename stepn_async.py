@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import time
+from datetime import datetime
+from functools import wraps
+
+from metrics import registry
+from stepn import StepnRequest, StepnAttempt, StepnNotAuthorized, StepnError, build_url, read_response
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+
+    `rate` tokens are added every second up to `capacity`, so up to `capacity` requests can be sent in a burst and
+    then `rate` requests per second on average.
+    """
+
+    def __init__(self, rate=1.0, capacity=1):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def slow_down(self):
+        """Halves the rate and empties the bucket after a throttled response, down to a 16th of the initial rate"""
+        self.refill()
+        self.rate = max(self.rate / 2, self.max_rate / 16)
+        self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        """Raises the rate back by a 10th of the initial rate after a success"""
+        if self.rate < self.max_rate:
+            self.refill()
+            self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+
+    async def acquire(self):
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+
+def async_http_stepn_watcher(function):
+    endpoint = function.__name__.removeprefix("get_")
+
+    async def call_logged_in(self, *args, **kwargs):
+        session_id = self.sessionID
+        try:
+            return await function(self, *args, **kwargs)
+        except StepnNotAuthorized:
+            # The session expired while scanning, log in again once and replay the call
+            await self.login(expired_session_id=session_id)
+            return await function(self, *args, **kwargs)
+
+    @wraps(function)
+    async def _async_http_stepn_watcher(self, *args, **kwargs):
+        for number in itertools.count():
+            with StepnAttempt(endpoint, number, limiter=self.limiter) as attempt:
+                response_json = await call_logged_in(self, *args, **kwargs)
+                # Any success proves the session is still valid
+                self.stepn.validated_at = time.time()
+                return response_json
+            await asyncio.sleep(attempt.delay)
+
+    return _async_http_stepn_watcher
+
+
+class AsyncStepnRequest(object):
+    """
+    Asyncio variant of StepnRequest.
+
+    Requests share one keep-alive connection pool and are throttled by a token bucket instead of a fixed sleep, so
+    pages and order details can be fetched concurrently up to the allowed rate.
+    The login flow is delegated to StepnRequest, both clients share the same cookies file.
+
+    Usage:
+        async with AsyncStepnRequest(email, password, google_2auth_secret) as stepn:
+            pages = await stepn.get_orderlist_pages(page_end=4, **params)
+    """
+
+    def __init__(self, email, password, google_2auth_secret=None, rate=1.0, burst=1, connections=10, timeout=30,
+                 cookies_filename='cookies'):
+        self.__email = email
+        self.__password = password
+        self.__google_2auth_secret = google_2auth_secret
+        self.cookies_filename = cookies_filename
+
+        self.limiter = TokenBucket(rate=rate, capacity=burst)
+        self.login_lock = asyncio.Lock()
+        self.connections = connections
+        self.timeout = timeout
+
+        self.stepn = None
+        self.session = None
+        self.sessionID = None
+        self.keeper = None
+        self.client_errors = ()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        # Only imported by the runs which use the async client
+        import aiohttp
+
+        # Network errors are retried like the HTTP 5xx
+        self.client_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self.stepn = await asyncio.to_thread(
+            StepnRequest,
+            email=self.__email,
+            password=self.__password,
+            google_2auth_secret=self.__google_2auth_secret,
+            cookies_filename=self.cookies_filename,
+            timeout=self.timeout,
+        )
+        self.sessionID = self.stepn.sessionID
+        self.keeper = asyncio.create_task(self.keep_alive())
+
+    async def close(self):
+        if self.keeper:
+            self.keeper.cancel()
+        if self.stepn:
+            # The next run starts from the last validation
+            await asyncio.to_thread(self.stepn.save_cookies)
+        if self.session:
+            await self.session.close()
+
+    async def keep_alive(self):
+        """Checks the session once idle for half its ttl, so that it is logged in again before it lapses"""
+        while True:
+            idle = time.time() - self.stepn.validated_at
+            await asyncio.sleep(max(self.stepn.session_ttl / 2 - idle, 1))
+
+            if time.time() - self.stepn.validated_at < self.stepn.session_ttl / 2:
+                continue
+
+            try:
+                await self.get_userbasic()
+                await asyncio.to_thread(self.stepn.save_cookies)
+            except Exception as e:
+                print(f"Impossible to keep the session alive: {e!r}")
+
+    async def login(self, expired_session_id=None):
+        async with self.login_lock:
+            # Concurrent requests failing together only need one new session
+            if expired_session_id is not None and expired_session_id != self.sessionID:
+                return
+            with registry.timer("stepn_login_seconds"):
+                await asyncio.to_thread(self.stepn.get_login)
+            self.sessionID = self.stepn.sessionID
+
+    def concurrency(self):
+        """Requests which can be sent at once"""
+        return max(int(self.limiter.capacity), 1)
+
+    async def get(self, endpoint, **kwargs):
+        with registry.timer("stepn_limiter_wait_seconds", endpoint=endpoint):
+            await self.limiter.acquire()
+
+        url = build_url(endpoint, **kwargs, sessionID=self.sessionID)
+        print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {url}")
+
+        started_at = time.perf_counter()
+        try:
+            async with self.session.get(url, cookies={"sessionID": str(self.sessionID)}) as response:
+                body = await response.read()
+        except self.client_errors as e:
+            raise StepnError(repr(e), retryable=True) from e
+
+        return read_response(endpoint, url, response.status, body, time.perf_counter() - started_at)
+
+    @async_http_stepn_watcher
+    async def get_userbasic(self):
+        return await self.get('userbasic')
+
+    @async_http_stepn_watcher
+    async def get_orderlist(self, **kwargs):
+        """Same parameters and response as StepnRequest.get_orderlist"""
+        return await self.get('orderlist', **kwargs)
+
+    @async_http_stepn_watcher
+    async def get_orderdata(self, order_id):
+        """Same response as StepnRequest.get_orderdata"""
+        return await self.get('orderdata', orderId=order_id)
+
+    async def iter_orderlist_pages(self, page_end, until=None, **kwargs):
+        """
+        Async generator of the rows of each page from kwargs['page'] to page_end, in order.
+
+        Pages are fetched concurrently by bursts of concurrency() pages and yielded as soon as their burst is there.
+        When `until(rows)` is true for a page, the following pages are not fetched.
+        """
+        pages = range(kwargs.pop('page', 0), page_end + 1)
+        size = self.concurrency()
+
+        for start in range(0, len(pages), size):
+            burst = pages[start:start + size]
+            responses = await asyncio.gather(*(self.get_orderlist(**kwargs, page=page) for page in burst))
+
+            for response in responses:
+                rows = response.get("data") or [] if response else []
+                yield rows
+                if until and until(rows):
+                    return
+
+    async def get_orderlist_pages(self, page_end, until=None, **kwargs):
+        """Same as iter_orderlist_pages, returns the rows of every page once they are all fetched"""
+        return [rows async for rows in self.iter_orderlist_pages(page_end, until=until, **kwargs)]
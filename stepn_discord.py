@@ -8,45 +8,180 @@ import secrets
 if platform.system() == 'Windows':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
+# Discord limits of one message, several embeds per message need discord.py 2, see requirements.txt
+MAX_CONTENT = 2000
+MAX_EMBEDS = 10 if discord.version_info.major >= 2 else 1
 
-class StepnClient(discord.Client):
 
-    def __init__(self, messages_dict):
-        super(StepnClient, self).__init__()
-        self.messages_dict = messages_dict
+def pack_messages(messages, mention=''):
+    """Packs the (message, image) alerts in as few (content, images) Discord messages as the limits allow"""
+    chunks = []
+    content, images = mention, []
+
+    for message, image in messages:
+        full = len(content) + len(message) + 1 > MAX_CONTENT or (image and len(images) >= MAX_EMBEDS)
+        if full and content != mention:
+            chunks.append((content, images))
+            content, images = mention, []
+
+        content = f"{content}{message}\n"[:MAX_CONTENT]
+        if image:
+            images.append(image)
+
+    if content != mention:
+        chunks.append((content, images))
+
+    return chunks
+
+
+async def send_chunk(channel, content, images):
+    embeds = [discord.Embed().set_image(url=image) for image in images]
+
+    if MAX_EMBEDS > 1:
+        await channel.send(content, embeds=embeds)
+    else:
+        await channel.send(content, embed=embeds[0] if embeds else None)
+
+
+class StepnDispatcher(object):
+    """
+    Sends the alerts to the stepn-marketplace channel of every guild.
+
+    The channel and the mention role of each guild are cached, the client updates them on the guild, channel and role
+    events. The alerts are packed in as few messages as possible and the guilds are sent to concurrently: each channel
+    is its own rate limit bucket, which discord.py waits for.
+    """
+
+    channel_name = 'stepn-marketplace'
+
+    def __init__(self, mention=None):
+        self.mention = mention
+        # guild id -> (channel, mention prefix)
+        self.targets = {}
+
+    def refresh(self, guild):
+        self.targets.pop(guild.id, None)
+
+        if secrets.DEBUG and str(guild) != secrets.DISCORD_NAME:
+            return
+
+        channel = discord.utils.get(guild.text_channels, name=self.channel_name)
+        if not channel:
+            return
+
+        role = discord.utils.get(guild.roles, name=self.mention) if self.mention else None
+        self.targets[guild.id] = (channel, f"{role.mention}\n" if role else '')
+
+    def forget(self, guild):
+        self.targets.pop(guild.id, None)
+
+    def refresh_all(self, guilds):
+        self.targets.clear()
+        for guild in guilds:
+            self.refresh(guild)
+
+    async def send(self, messages):
+        if messages:
+            await asyncio.gather(*(
+                self.send_guild(channel, mention, messages) for channel, mention in self.targets.values()
+            ))
+
+    @staticmethod
+    async def send_guild(channel, mention, messages):
+        try:
+            for content, images in pack_messages(messages, mention):
+                await send_chunk(channel, content, images)
+        except discord.DiscordException as e:
+            print(f"Impossible to send the alerts to {channel.guild}: {e}")
+
+
+class StepnDispatchClient(discord.Client):
+    """Client keeping the StepnDispatcher cache up to date"""
+
+    def __init__(self, mention=None):
+        # The default intents hold the guild, channel and role events the dispatcher cache is updated on
+        super(StepnDispatchClient, self).__init__(intents=discord.Intents.default())
+        self.dispatcher = StepnDispatcher(mention=mention)
 
     async def on_ready(self):
         print('Logged in as {0.user}'.format(self))
+        self.dispatcher.refresh_all(self.guilds)
+
+    async def on_guild_join(self, guild):
+        self.dispatcher.refresh(guild)
+
+    async def on_guild_available(self, guild):
+        self.dispatcher.refresh(guild)
+
+    async def on_guild_update(self, before, after):
+        self.dispatcher.refresh(after)
+
+    async def on_guild_remove(self, guild):
+        self.dispatcher.forget(guild)
 
-        for guild in self.guilds:
+    async def on_guild_channel_create(self, channel):
+        self.dispatcher.refresh(channel.guild)
 
-            g_roles: dict = {}
-            g_channels: dict = {}
+    async def on_guild_channel_delete(self, channel):
+        self.dispatcher.refresh(channel.guild)
 
-            for role in guild.roles:
-                g_roles[role.name] = role
+    async def on_guild_channel_update(self, before, after):
+        self.dispatcher.refresh(after.guild)
 
-            for channel in guild.channels:
-                g_channels[channel.name] = channel
+    async def on_guild_role_create(self, role):
+        self.dispatcher.refresh(role.guild)
 
-            if secrets.DEBUG and str(guild) != secrets.DISCORD_NAME:
-                continue
+    async def on_guild_role_delete(self, role):
+        self.dispatcher.refresh(role.guild)
 
-            if 'stepn-marketplace' in g_channels:
-                channel = g_channels['stepn-marketplace']
-                messages = self.messages_dict["messages"]
+    async def on_guild_role_update(self, before, after):
+        self.dispatcher.refresh(after.guild)
+
+
+class StepnClient(StepnDispatchClient):
+
+    def __init__(self, messages_dict):
+        super(StepnClient, self).__init__(mention=messages_dict.get('mention'))
+        self.messages_dict = messages_dict
 
-                mention = None
-                if messages:
-                    if self.messages_dict.get('mention'):
-                        mention = f"{g_roles[self.messages_dict.get('mention')].mention}\n"
+    async def on_ready(self):
+        await super(StepnClient, self).on_ready()
 
-                    for message, image in messages:
-                        if image:
-                            embed = discord.Embed()
-                            embed.set_image(url=image)
-                            await channel.send(f"{mention}{message}", embed=embed)
-                        else:
-                            await channel.send(f"{mention}{message}")
+        await self.dispatcher.send(self.messages_dict["messages"])
 
         await self.close()
+
+
+class StepnWatcherClient(StepnDispatchClient):
+    """
+    Long-running client: stays connected to the gateway and sends every (message, image) put in the queue.
+    """
+
+    def __init__(self, queue, mention=None):
+        super(StepnWatcherClient, self).__init__(mention=mention)
+        self.queue = queue
+        self.sender = None
+
+    async def on_ready(self):
+        await super(StepnWatcherClient, self).on_ready()
+
+        # on_ready is called again after every reconnection
+        if not self.sender:
+            self.sender = asyncio.create_task(self.send_queue())
+
+    async def send_queue(self):
+        while True:
+            messages = [await self.queue.get()]
+            # Everything already queued is sent with it
+            while not self.queue.empty():
+                messages.append(self.queue.get_nowait())
+
+            await self.dispatcher.send(messages)
+
+            for _ in messages:
+                self.queue.task_done()
+
+    async def close(self):
+        if self.sender:
+            self.sender.cancel()
+        await super(StepnWatcherClient, self).close()
@@ -0,0 +1,119 @@
+import asyncio
+
+from stepn import StepnNotAuthorized
+from stepn_async import AsyncStepnRequest
+
+
+class AsyncStepnPool(object):
+    """
+    Pool of AsyncStepnRequest sessions, one per account, each with its own cookies file and token bucket.
+
+    Requests go to the healthy session with the most tokens left, so the pool sends up to the sum of the account rates.
+    A session still not authorized once logged in again is dropped from the pool while it logs in again in the
+    background, and the request is replayed on another session.
+
+    Usage:
+        async with AsyncStepnPool([{"email": ..., "password": ..., "google_2auth_secret": ...}, ...]) as stepn:
+            pages = await stepn.get_orderlist_pages(page_end=4, **params)
+    """
+
+    def __init__(self, accounts, rate=1.0, burst=1, connections=10, timeout=30):
+        self.clients = [
+            AsyncStepnRequest(
+                email=account["email"],
+                password=account["password"],
+                google_2auth_secret=account.get("google_2auth_secret"),
+                rate=rate,
+                burst=burst,
+                connections=connections,
+                timeout=timeout,
+                cookies_filename=account.get("cookies_filename", f"cookies.{account['email']}"),
+            )
+            for account in accounts
+        ]
+        self.healthy = []
+        # client -> task logging it in again
+        self.relogins = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        results = await asyncio.gather(*(client.start() for client in self.clients), return_exceptions=True)
+
+        for client, result in zip(self.clients, results):
+            if isinstance(result, Exception):
+                print(f"Impossible to log in {client.cookies_filename}: {result!r}")
+                self.relogin(client)
+            else:
+                self.healthy.append(client)
+
+        if not self.healthy:
+            raise Exception('Impossible to log in any account of the pool')
+
+    async def close(self):
+        for task in self.relogins.values():
+            task.cancel()
+        await asyncio.gather(*(client.close() for client in self.clients))
+
+    def concurrency(self):
+        """Requests which can be sent at once by the healthy sessions"""
+        return max(sum(client.concurrency() for client in self.healthy), 1)
+
+    def pick(self):
+        """The healthy session which will wait the least for its limiter"""
+        if not self.healthy:
+            raise StepnNotAuthorized('No logged in session left in the pool')
+
+        for client in self.healthy:
+            client.limiter.refill()
+        return max(self.healthy, key=lambda client: client.limiter.tokens)
+
+    def relogin(self, client):
+        """Drops the session from the pool until it is logged in again"""
+        if client in self.relogins:
+            return
+        if client in self.healthy:
+            self.healthy.remove(client)
+
+        async def _relogin():
+            try:
+                if client.stepn:
+                    await client.login()
+                else:
+                    await client.close()
+                    await client.start()
+            except Exception as e:
+                print(f"Impossible to log in {client.cookies_filename} again: {e!r}")
+                return
+            finally:
+                del self.relogins[client]
+            self.healthy.append(client)
+
+        self.relogins[client] = asyncio.create_task(_relogin())
+
+    async def call(self, method, *args, **kwargs):
+        # One attempt per session at most
+        for _ in range(len(self.clients)):
+            client = self.pick()
+            try:
+                return await getattr(client, method)(*args, **kwargs)
+            except StepnNotAuthorized:
+                self.relogin(client)
+
+        raise StepnNotAuthorized()
+
+    async def get_orderlist(self, **kwargs):
+        """Same parameters and response as StepnRequest.get_orderlist"""
+        return await self.call('get_orderlist', **kwargs)
+
+    async def get_orderdata(self, order_id):
+        """Same response as StepnRequest.get_orderdata"""
+        return await self.call('get_orderdata', order_id)
+
+    iter_orderlist_pages = AsyncStepnRequest.iter_orderlist_pages
+    get_orderlist_pages = AsyncStepnRequest.get_orderlist_pages
@@ -0,0 +1,153 @@
+import os
+
+import pytest
+
+import main
+from cache import OrderDataCache
+from history import PriceHistory
+from models import decode_response
+from rules import Rule
+from seen import SeenIndex
+from stepn import StepnError, mapping_order, orderlist_page_size
+
+
+class FakeStepn(object):
+    """StepnRequest answering the orderlist pages it is given"""
+
+    def __init__(self):
+        self.pages = [[]]
+        self.requests = []
+
+    def get_orderlist(self, page=0, **kwargs):
+        self.requests.append(page)
+        rows = self.pages[page] if page < len(self.pages) else []
+        if isinstance(rows, Exception):
+            raise rows
+        return decode_response("orderlist", {"code": 0, "data": rows})
+
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch):
+    monkeypatch.setattr(main, "order_cache", OrderDataCache())
+    monkeypatch.setattr(main, "seen_index", SeenIndex())
+    monkeypatch.setattr(main, "price_history", PriceHistory(":memory:"))
+    # The records are written at exit, after the fixtures are undone
+    main.logger.filename = os.devnull
+
+
+def listing(order_id, price):
+    return {"id": order_id, "sellPrice": price * 100, "level": 5, "quality": 1, "mint": 0, "img": "shoe.png"}
+
+
+def price_rule(**item):
+    return Rule({
+        "title": "floor",
+        "conditions": "%sellPrice > 0",
+        "params": {"order": 2001, "chain": 103, "refresh": "true", "page": 0, "type": 600},
+        "page_end": 0,
+        "price": 100,
+        "threshold": 5,
+        **item,
+    })
+
+
+def test_price_rule_evaluates_the_seen_listings_again_once_its_limit_changed():
+    stepn, rule = FakeStepn(), price_rule()
+
+    stepn.pages = [[listing(1, 103)]]
+    assert main.check_rule(stepn, rule) == []
+
+    stepn.pages = [[listing(2, 90), listing(1, 103)]]
+    assert len(main.check_rule(stepn, rule)) == 1
+    assert rule.price == 90
+
+    stepn.pages = [[listing(1, 103)]]
+    assert len(main.check_rule(stepn, rule)) == 1
+
+
+def test_rule_skips_the_listings_seen_against_the_same_limit():
+    stepn, rule = FakeStepn(), price_rule()
+    stepn.pages = [[listing(1, 103)]]
+
+    main.check_rule(stepn, rule)
+    main.check_rule(stepn, rule)
+
+    assert rule.new_listings == 1
+    assert main.seen_index.skipped == 1
+
+
+def test_moving_average_rule_always_evaluates_its_listings():
+    stepn, rule = FakeStepn(), price_rule(baseline_window=3600)
+    stepn.pages = [[listing(1, 103)]]
+
+    main.check_rule(stepn, rule)
+    main.check_rule(stepn, rule)
+
+    assert rule.new_listings == 2
+    assert main.seen_index.skipped == 0
+
+
+def full_page(first_price):
+    return [listing(first_price * 100 + index, first_price + index / 100) for index in range(orderlist_page_size)]
+
+
+def test_rule_stops_paginating_past_its_price_bound():
+    stepn = FakeStepn()
+    stepn.pages = [full_page(10), full_page(20), full_page(30), full_page(40)]
+    rule = price_rule(conditions="%sellPrice < 25 and %level > 5", price=None, page_end=3)
+
+    main.check_rule(stepn, rule)
+
+    assert stepn.requests == [0, 1, 2]
+
+
+def test_rule_stops_paginating_after_the_last_page():
+    stepn = FakeStepn()
+    stepn.pages = [full_page(10), full_page(20)[:5]]
+    rule = price_rule(conditions="%sellPrice > 1000", price=None, page_end=3)
+
+    main.check_rule(stepn, rule)
+
+    assert stepn.requests == [0, 1]
+
+
+def latest_page(newest):
+    return [{**listing(newest - index, 100), "time": newest - index} for index in range(orderlist_page_size)]
+
+
+def latest_rule():
+    return price_rule(conditions="%level > 5", price=None, page_end=3,
+                      params={"order": mapping_order["latest"], "chain": 103, "page": 0, "type": 600})
+
+
+def test_latest_rule_stops_at_the_listings_of_its_previous_sweep():
+    stepn, rule = FakeStepn(), latest_rule()
+    stepn.pages = [latest_page(1000), latest_page(1000 - orderlist_page_size), []]
+
+    main.check_rule(stepn, rule)
+    assert stepn.requests == [0, 1, 2]
+
+    stepn.requests = []
+    main.check_rule(stepn, rule)
+    assert stepn.requests == [0]
+
+
+def test_latest_rule_checks_again_the_pages_left_by_a_sweep_stopped_early():
+    stepn, rule = FakeStepn(), latest_rule()
+    stepn.pages = [latest_page(1000), StepnError("Server error", retryable=True)]
+
+    main.check_rule(stepn, rule)
+    assert rule.watermark is None
+
+    stepn.pages = [latest_page(1000), latest_page(1000 - orderlist_page_size), []]
+    stepn.requests = []
+    main.check_rule(stepn, rule)
+    assert stepn.requests == [0, 1, 2]
+
+
+def test_rule_stops_at_its_first_alert():
+    stepn = FakeStepn()
+    stepn.pages = [full_page(10)]
+    rule = price_rule(conditions="%sellPrice < 25", price=None)
+
+    assert len(main.check_rule(stepn, rule)) == 1
@@ -0,0 +1,66 @@
+from planner import SharedOrderlist, orderlist_key, plan
+from rules import Rule
+from stepn import mapping_order
+
+params = {"order": mapping_order["lowest_price"], "chain": 103, "refresh": "true", "page": 0, "type": 600}
+
+
+def rule(title, conditions, **item):
+    return Rule({"title": title, "conditions": conditions, "params": params, "page_end": 4, **item})
+
+
+class CountingStepn(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_orderlist(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"code": 0, "data": []}
+
+
+def test_orderlist_key_ignores_the_empty_params():
+    assert orderlist_key({**params, "quality": ""}) == orderlist_key(params)
+    assert orderlist_key({**params, "quality": 3}) != orderlist_key(params)
+
+
+def test_plan_groups_the_rules_by_requests():
+    cheap, cheaper, rare = rule("cheap", "%sellPrice < 100"), rule("cheaper", "%sellPrice < 50"), rule(
+        "rare", "%quality == 5")
+
+    groups = plan([cheap, cheaper, rare])
+
+    assert sorted(groups.values(), key=len) == [[rare], [cheap, cheaper]]
+
+
+def test_plan_unsplits_the_rules_sharing_their_pages():
+    split, shared = rule("split", "%quality in (3, 4)"), rule("shared", "%sellPrice < 100")
+    assert len(split.requests) == 2
+
+    groups = plan([split, shared])
+
+    assert split.requests == [params]
+    assert list(groups.values()) == [[split, shared]]
+
+
+def test_plan_keeps_the_split_of_a_rule_alone_on_its_pages():
+    split, other = rule("split", "%quality in (3, 4)"), rule("other", "%quality == 5")
+
+    plan([split, other])
+
+    assert len(split.requests) == 2
+
+
+def test_shared_orderlist_fetches_each_page_once():
+    stepn = CountingStepn()
+    shared = SharedOrderlist(stepn)
+
+    shared.get_orderlist(**params)
+    shared.get_orderlist(**{**params, "quality": ""})
+    shared.get_orderlist(**{**params, "page": 1})
+
+    assert len(stepn.calls) == 2
+    assert shared.stats() == {"requests": 2, "shared": 1}
+
+    shared.release()
+    shared.get_orderlist(**params)
+    assert len(stepn.calls) == 3
@@ -0,0 +1,137 @@
+import pytest
+
+from retry import CircuitBreaker, RetryBudget, RetryPolicy
+from stepn import StepnAttempt, StepnCircuitOpen, StepnError, StepnNotFound, StepnRequest, StepnThrottled
+
+
+class Limiter(object):
+    def __init__(self):
+        self.calls = []
+
+    def slow_down(self):
+        self.calls.append("slow_down")
+
+    def speed_up(self):
+        self.calls.append("speed_up")
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    policy = RetryPolicy(attempts=3, base_delay=0.5, budget_minimum=10, breaker_threshold=2, breaker_timeout=60)
+    monkeypatch.setattr(StepnRequest, "retry_policy", policy)
+    return policy
+
+
+def test_retry_budget_allows_a_ratio_of_the_requests():
+    budget = RetryBudget(ratio=0.5, minimum=1, window=60)
+    for _ in range(4):
+        budget.request(0)
+
+    assert [budget.withdraw(1) for _ in range(4)] == [True, True, True, False]
+    # The requests and retries older than the window are forgotten
+    assert budget.withdraw(61)
+
+
+def test_circuit_breaker_opens_after_the_threshold():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+
+    breaker.failure(0)
+    assert breaker.state == "closed"
+    breaker.success()
+    breaker.failure(1)
+    assert breaker.allow(1)
+
+    breaker.failure(2)
+    assert breaker.state == "open"
+    assert not breaker.allow(61)
+
+
+def test_circuit_breaker_lets_one_trial_through():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+    breaker.failure(0)
+
+    assert breaker.allow(60)
+    assert breaker.state == "half-open"
+    assert not breaker.allow(61)
+
+    breaker.failure(62)
+    assert breaker.state == "open"
+    assert breaker.allow(122)
+    breaker.success()
+    assert breaker.state == "closed"
+
+
+def test_retry_policy_backoff_is_capped(policy):
+    policy.max_delay = 1
+
+    assert all(0 <= policy.backoff(attempt) <= 1 for attempt in range(10))
+
+
+def test_retry_policy_stops_after_the_attempts(policy):
+    assert policy.failure("orderlist", retryable=True, attempt=0) is not None
+    assert policy.failure("orderlist", retryable=True, attempt=2) is None
+
+
+def test_retry_policy_ignores_the_final_failures_in_the_breaker(policy):
+    for _ in range(5):
+        assert policy.failure("orderlist", retryable=False, attempt=0) is None
+
+    assert policy.allow("orderlist")
+    assert policy.stats() == {"orderlist": "closed"}
+
+
+def test_retry_policy_reset(policy):
+    policy.failure("orderlist", retryable=True, attempt=0)
+    policy.failure("orderlist", retryable=True, attempt=1)
+    assert not policy.allow("orderlist")
+
+    policy.reset()
+    assert policy.allow("orderlist")
+
+
+def test_stepn_attempt_success(policy):
+    limiter = Limiter()
+
+    with StepnAttempt("orderlist", 0, limiter) as attempt:
+        pass
+
+    assert attempt.delay is None
+    assert limiter.calls == ["speed_up"]
+
+
+def test_stepn_attempt_suppresses_the_retryable_failures(policy):
+    limiter = Limiter()
+
+    with StepnAttempt("orderlist", 0, limiter) as attempt:
+        raise StepnThrottled()
+
+    assert attempt.delay is not None
+    assert limiter.calls == ["slow_down"]
+
+
+@pytest.mark.parametrize("error", [StepnError("Unknown code", code=1), StepnNotFound(), ValueError()])
+def test_stepn_attempt_raises_the_final_failures(policy, error):
+    with pytest.raises(type(error)):
+        with StepnAttempt("orderlist", 0, Limiter()):
+            raise error
+
+    assert policy.stats() in ({}, {"orderlist": "closed"})
+
+
+def test_stepn_attempt_raises_the_last_retryable_failure(policy):
+    with pytest.raises(StepnError):
+        with StepnAttempt("orderlist", 2, Limiter()):
+            raise StepnError("Server error", retryable=True)
+
+
+def test_stepn_attempt_fails_fast_while_the_circuit_is_open(policy):
+    with StepnAttempt("orderlist", 0, Limiter()):
+        raise StepnError("Server error", retryable=True)
+    # The failure opening the breaker isn't retried
+    with pytest.raises(StepnError):
+        with StepnAttempt("orderlist", 1, Limiter()):
+            raise StepnError("Server error", retryable=True)
+
+    with pytest.raises(StepnCircuitOpen):
+        with StepnAttempt("orderlist", 0, Limiter()):
+            pass
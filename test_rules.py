@@ -0,0 +1,174 @@
+import pytest
+
+from batch import compile_batch_conditions
+from models import OrderRow
+from rules import Rule, RuleError, compile_conditions, find_pushdown
+from stepn import StepnRequest, mapping_order, orderlist_page_size
+
+rows = [
+    {"id": 1, "sellPrice": 1160000, "level": 5, "quality": 1, "mint": 2, "speedMax": 556},
+    {"id": 2, "sellPrice": 1170000, "level": 9, "quality": 3, "mint": 0, "speedMax": 278},
+    {"id": 3, "sellPrice": 2500000, "level": 28, "quality": 5, "mint": 7, "speedMax": 167},
+]
+
+conditions = [
+    "%sellPrice < 11700",
+    "%sellPrice <= 11700 and %quality in (3, 4)",
+    "%level >= 9 or %mint == 0",
+    "not %quality == 1",
+    "%level + %mint > 10 and %mint != 2",
+    "%sellPrice * 1.1 > 20000",
+    "5 <= %level < 10",
+    "%quality not in [1, 2] and -%mint < -1",
+]
+
+
+def evaluate_substituted(conditions, row):
+    """The evaluation the compiler replaced: the values substituted in the conditions string, then eval"""
+    row = {**row, "sellPrice": StepnRequest.reduce_price(row["sellPrice"])}
+
+    while "%" in conditions:
+        var = conditions.split('%')[1].split()[0]
+        conditions = conditions.replace(f"%{var}", f"{row.get(var)}")
+
+    return eval(conditions)
+
+
+@pytest.mark.parametrize("condition", conditions)
+def test_compile_conditions_matches_substitution(condition):
+    predicate = compile_conditions(condition)
+
+    for row in rows:
+        assert bool(predicate(OrderRow(row))) == bool(evaluate_substituted(condition, row)), row
+
+
+@pytest.mark.parametrize("condition", [
+    "__import__('os').system('true')",
+    "open('secrets.py')",
+    "(%level).__class__",
+    "%level > os",
+    "[x for x in (1, 2)]",
+    "{x: 1 for x in (1, 2)}",
+    "(lambda: 1)()",
+    "%level if %mint else 1",
+    "(%mint)[0]",
+    "f'{%level}'",
+])
+def test_compile_conditions_rejects_anything_else(condition):
+    with pytest.raises(RuleError):
+        compile_conditions(condition)
+
+
+def test_compile_conditions_reads_vars_in_collections():
+    # The substitution garbled the vars followed by a comma
+    predicate = compile_conditions("%level in (%mint, 5)")
+
+    assert [bool(predicate(OrderRow(row))) for row in rows] == [True, False, False]
+
+
+def test_compile_conditions_rejects_invalid_vars():
+    with pytest.raises(RuleError, match="conditions_on_stats"):
+        compile_conditions("%attr.Luck > 10")
+    with pytest.raises(RuleError, match="Invalid conditions"):
+        compile_conditions("%level >")
+
+
+def test_errors_show_the_binded_vars():
+    with pytest.raises(RuleError) as error:
+        compile_conditions("%level > 5 and open(%mint)")
+    assert "%mint" in error.value.message
+    assert "__var" not in error.value.message
+
+    with pytest.raises(RuleError) as error:
+        compile_batch_conditions("%level in (%mint, 5)")
+    assert "(%mint, 5)" in error.value.message
+    assert "__var" not in error.value.message
+
+
+params = {"order": mapping_order["lowest_price"], "chain": 103, "refresh": "true", "page": 0, "type": 600}
+
+
+def rule(conditions, **item):
+    return Rule({"title": "rule", "conditions": conditions, "params": params, "page_end": 4, **item})
+
+
+def test_find_pushdown_pushes_a_single_value():
+    requests, pages, residual = find_pushdown("%quality == 5 and %sellPrice < 100", params, pages=5)
+
+    assert requests == [{**params, "quality": 5}]
+    assert pages == 1
+    assert residual == "(%sellPrice < 100)"
+
+
+def test_find_pushdown_splits_when_it_saves_pages():
+    requests, pages, residual = find_pushdown("%quality in (3, 4)", params, pages=5)
+
+    assert requests == [{**params, "quality": 3}, {**params, "quality": 4}]
+    assert pages == 1
+    assert residual == "True"
+
+
+@pytest.mark.parametrize("conditions, pages, max_splits", [
+    # Two requests of one page each instead of one page
+    ("%quality in (3, 4)", 1, 4),
+    # Three requests of one page each instead of two pages
+    ("%quality >= 3", 2, 4),
+    ("%level >= 25", 100, 4),
+    ("%quality in (3, 4)", 5, 1),
+])
+def test_find_pushdown_keeps_the_splits_fetching_more_pages(conditions, pages, max_splits):
+    assert find_pushdown(conditions, params, pages=pages, max_splits=max_splits) == ([params], pages, conditions)
+
+
+def test_find_pushdown_keeps_the_params_of_the_rule():
+    quality_params = {**params, "quality": 2}
+
+    assert find_pushdown("%quality == 5", quality_params, pages=5) == ([quality_params], 5, "%quality == 5")
+
+
+def test_find_pushdown_keeps_the_conditions_on_several_fields():
+    requests, _, residual = find_pushdown("%quality == %mint + 1 and %level == 5", params, pages=5)
+
+    assert requests == [{**params, "level": 5}]
+    assert residual == "(%quality == %mint + 1)"
+
+
+def test_rule_requests():
+    split = rule("%quality in (3, 4) and %sellPrice < 100")
+
+    assert split.requests == [{**params, "quality": 3}, {**params, "quality": 4}]
+    assert split.unsplit_params == params
+    assert split.request_page_end == 0
+    assert split.conditions(OrderRow({"sellPrice": 9000, "quality": 1}))
+
+    split.unsplit()
+    assert split.requests == [params]
+    assert split.request_page_end == 4
+    assert not split.conditions(OrderRow({"sellPrice": 9000, "quality": 1}))
+
+    assert rule("%quality in (3, 4)", pushdown=False).requests == [params]
+
+
+def page(*prices, size=orderlist_page_size):
+    return [OrderRow({"id": index, "sellPrice": price * 100}) for index, price in enumerate(prices)] * (
+        size // len(prices)
+    )
+
+
+def test_is_exhausted():
+    bounded = rule("%sellPrice < 100")
+
+    assert bounded.is_exhausted([])
+    assert bounded.is_exhausted(page(50, size=10))
+    assert not bounded.is_exhausted(page(50))
+    assert bounded.is_exhausted(page(50, 150))
+    assert not rule("%level > 5").is_exhausted(page(50, 150))
+
+
+def test_is_exhausted_by_the_watermark():
+    latest = rule("%level > 5", params={**params, "order": mapping_order["latest"]})
+    rows = [OrderRow({"id": index, "time": 1000 - index}) for index in range(orderlist_page_size)]
+
+    assert not latest.is_exhausted(rows, watermark=None)
+    assert not latest.is_exhausted(rows, watermark=(900, 0))
+    assert latest.is_exhausted(rows, watermark=(1000 - orderlist_page_size + 1, orderlist_page_size - 1))